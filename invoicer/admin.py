@@ -1,4 +1,5 @@
 from django.contrib import admin
+from invoicer import sendqueue
 from invoicer.models import *
 
 class ProductAdmin(admin.ModelAdmin):
@@ -37,8 +38,27 @@ class ContactAdmin(admin.ModelAdmin):
     list_filter = ('priceband', )
     search_fields = ('name', 'notes')
 
+class XeroContactAdmin(admin.ModelAdmin):
+    list_display = ('name', 'full_name', 'status', 'updated')
+    list_filter = ('status', )
+    search_fields = ('name', 'full_name')
+
+class SendJobAdmin(admin.ModelAdmin):
+    list_display = ('__str__', 'date', 'status', 'attempts', 'created',
+                    'user')
+    list_filter = ('status', 'bill')
+    search_fields = ('contact_name', 'invoice_id')
+    filter_horizontal = ('products', )
+    actions = ['send_again']
+
+    @admin.action(description="Send again, even if already sent")
+    def send_again(self, request, queryset):
+        sendqueue.send_again(queryset)
+
 admin.site.register(PriceBand)
 admin.site.register(Contact, ContactAdmin)
+admin.site.register(XeroContact, XeroContactAdmin)
+admin.site.register(SendJob, SendJobAdmin)
 admin.site.register(ProductType)
 admin.site.register(Unit)
 admin.site.register(Product, ProductAdmin)
@@ -0,0 +1,103 @@
+"""Work done in background threads
+
+Each piece of work has a key; asking for work that is already queued
+or running under the same key gets the existing Future instead of
+starting it again.  Database connections opened by the work are closed
+when it finishes.
+
+Work that a request has to wait for anyway is done in the request's
+own thread with run_here, rather than waiting behind long-running work
+for a background thread.
+"""
+from concurrent.futures import Future, ThreadPoolExecutor
+from django.conf import settings
+from django.db import connections
+import logging
+import threading
+log = logging.getLogger(__name__)
+
+_lock = threading.Lock()
+_executor = None
+_running = {}
+_again = {}
+
+
+def _call(key, fn, args, kwargs):
+    try:
+        return fn(*args, **kwargs)
+    except Exception:
+        log.exception("Background work %s failed", key)
+        raise
+    finally:
+        connections.close_all()
+        with _lock:
+            again = _again.pop(key, None)
+            if again:
+                _running[key] = _executor.submit(_call, key, *again)
+            else:
+                del _running[key]
+
+
+def run_once(key, fn, *args, **kwargs):
+    """Call fn in the background unless it's already running for key
+
+    Return the Future for the call.
+    """
+    global _executor
+    with _lock:
+        future = _running.get(key)
+        if future is None:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(
+                    max_workers=getattr(settings, 'BACKGROUND_THREADS', 2),
+                    thread_name_prefix="invoicer")
+            future = _executor.submit(_call, key, fn, args, kwargs)
+            _running[key] = future
+        return future
+
+
+def run_again(key, fn, *args, **kwargs):
+    """As run_once, but if fn is already running for key, call it again
+
+    The second call starts when the first finishes, so that it sees
+    whatever the caller has just done even if the first has already
+    looked.
+    """
+    with _lock:
+        future = _running.get(key)
+        if future is not None and future.running():
+            _again[key] = (fn, args, kwargs)
+            return future
+    return run_once(key, fn, *args, **kwargs)
+
+
+def run_here(key, fn, *args, **kwargs):
+    """Call fn in this thread unless it's already running for key
+
+    If it is, wait for that call instead.  Work for key that is still
+    waiting for a background thread is cancelled and done here.
+    Return the result of the call.
+    """
+    with _lock:
+        future = _running.get(key)
+        if future is not None and future.cancel():
+            future = None
+        if future is not None:
+            mine = False
+        else:
+            future = _running[key] = Future()
+            future.set_running_or_notify_cancel()
+            mine = True
+    if not mine:
+        return future.result()
+    try:
+        result = fn(*args, **kwargs)
+    except BaseException as e:
+        future.set_exception(e)
+        raise
+    else:
+        future.set_result(result)
+        return result
+    finally:
+        with _lock:
+            del _running[key]
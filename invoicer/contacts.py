@@ -0,0 +1,217 @@
+"""A local copy of the contacts on Xero
+
+Contact completions are answered from XeroContact rather than by
+asking Xero on every keystroke.  The copy is refreshed in the
+background when it is more than settings.CONTACT_SYNC_INTERVAL seconds
+old, or by the synccontacts command.  Only contacts changed since the
+last sync are fetched.
+
+The invoice page shows the details it has for a contact straight
+away, and fetches them again in the background if they're stale.
+"""
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import Case, IntegerField, Value, When
+from django.utils import timezone
+from invoicer import background, xero
+from invoicer.models import Contact, XeroContact, XeroSync, price_rules
+import datetime
+import logging
+import time
+log = logging.getLogger(__name__)
+
+synced_key = 'invoicer-contacts-synced'
+
+_terms = ('bill_days', 'bill_terms', 'invoice_days', 'invoice_terms')
+_fields = ('name', 'full_name', 'status', 'updated') + _terms
+
+
+def _values(d):
+    """XeroContact fields from a dict from xero.iter_contacts"""
+    return {
+        'name': d["Name"] or "",
+        'full_name': d["FullName"].strip(),
+        'status': d["ContactStatus"],
+        'updated': d["UpdatedDateUTC"],
+        'bill_days': d.get("BillDay", None),
+        'bill_terms': d.get("BillType", ""),
+        'invoice_days': d.get("SaleDay", None),
+        'invoice_terms': d.get("SaleType", ""),
+    }
+
+
+@transaction.atomic
+def _save(batch):
+    """Write a batch of contacts from Xero to XeroContact and Contact"""
+    values = {d["ContactID"]: _values(d) for d in batch}
+    new = []
+    changed = []
+    existing = {c.contact_id: c for c in XeroContact.objects.filter(
+        contact_id__in=values)}
+    for contact_id, v in values.items():
+        c = existing.get(contact_id)
+        if c is None:
+            new.append(XeroContact(contact_id=contact_id, **v))
+        elif any(getattr(c, f) != v[f] for f in _fields):
+            for f in _fields:
+                setattr(c, f, v[f])
+            changed.append(c)
+    XeroContact.objects.bulk_create(new)
+    XeroContact.objects.bulk_update(changed, _fields)
+
+    # Contacts we keep extra details for get fresh names and terms, as
+    # though the invoice page had just fetched them
+    now = timezone.now()
+    local = list(Contact.objects.filter(xero_id__in=values))
+    for c in local:
+        v = values[c.xero_id]
+        c.name = v['name']
+        c.updated = now
+        for f in _terms:
+            setattr(c, f, v[f])
+    Contact.objects.bulk_update(local, ('name', 'updated') + _terms)
+    # bulk_update doesn't send post_save, which the price rule index
+    # relies on to notice contacts' names changing
+    if any(price_rules.mentions_contact(c.pk) for c in local):
+        transaction.on_commit(price_rules.invalidate)
+    return len(new), len(changed)
+
+
+def sync(request, batch_size=500):
+    """Copy Xero contacts changed since the last sync into XeroContact
+
+    The first sync copies every contact.  Contacts that have a Contact
+    get its name and payment terms updated too.  Return the number of
+    contacts copied.
+
+    Each process refreshes the copy by itself, so a sync holds a lock
+    on its XeroSync row; one started meanwhile does nothing, and
+    returns 0.
+    """
+    XeroSync.objects.get_or_create(name='contacts')
+    with transaction.atomic():
+        state = XeroSync.objects.select_for_update(skip_locked=True)\
+                                .filter(name='contacts').first()
+        if state is None:
+            log.info("Xero contacts are already being synced")
+            return 0
+        return _sync(request, state, batch_size)
+
+
+def _sync(request, state, batch_size):
+    """sync, once the lock on its XeroSync row state is held"""
+    high_water = state.high_water
+    counts = [0, 0, 0] # copied, new, changed
+    batch = []
+
+    def save():
+        new, changed = _save(batch)
+        counts[0] += len(batch)
+        counts[1] += new
+        counts[2] += changed
+        batch.clear()
+
+    for d in xero.iter_contacts(request, modified_since=state.high_water):
+        batch.append(d)
+        if d["UpdatedDateUTC"] and (
+                high_water is None or d["UpdatedDateUTC"] > high_water):
+            high_water = d["UpdatedDateUTC"]
+        if len(batch) >= batch_size:
+            save()
+    if batch:
+        save()
+    # Only move the high water mark once everything before it is saved
+    state.high_water = high_water
+    state.synced = timezone.now()
+    state.save()
+    cache.set(synced_key, time.time(), None)
+    log.info("Synced %d Xero contacts: %d new, %d changed", *counts)
+    return counts[0]
+
+
+def refresh(request):
+    """Start a sync in the background if the copy is out of date"""
+    synced = cache.get(synced_key)
+    if synced is None or time.time() - synced > getattr(
+            settings, 'CONTACT_SYNC_INTERVAL', 600):
+        background.run_once('sync-contacts', sync, request)
+
+
+def _update(contact_id, d):
+    """Save a contact's details, as from xero.get_contact, to the copies"""
+    v = {'name': d["Name"] or "",
+         'bill_days': d.get("BillDay", None),
+         'bill_terms': d.get("BillType", ""),
+         'invoice_days': d.get("SaleDay", None),
+         'invoice_terms': d.get("SaleType", "")}
+    XeroContact.objects.filter(contact_id=contact_id).update(**v)
+    # Not Contact.save(), which would overwrite the price band and notes
+    # if someone else is saving them
+    Contact.objects.filter(xero_id=contact_id).update(
+        updated=timezone.now(), **v)
+    c = Contact.objects.filter(xero_id=contact_id).first()
+    if c and price_rules.mentions_contact(c.pk):
+        price_rules.invalidate()
+
+
+def fetch(request, contact_id):
+    """Fetch a contact from Xero and update the copies
+
+    Return the details as from xero.get_contact.
+    """
+    d = xero.get_contact(request, contact_id)
+    if d:
+        _update(contact_id, d)
+    return d
+
+
+def _fetch_key(contact_id):
+    return "contact-{}".format(contact_id)
+
+
+def details(request, contact_id):
+    """A contact's details, as from xero.get_contact
+
+    They come from the XeroContact if there is one; otherwise they are
+    fetched from Xero in this thread, or by a fetch already running.
+    """
+    c = XeroContact.objects.filter(contact_id=contact_id).first()
+    if c is None:
+        return background.run_here(
+            _fetch_key(contact_id), fetch, request, contact_id)
+    return {
+        "ContactID": c.contact_id,
+        "Name": c.name,
+        "FullName": c.full_name,
+        "BillDay": c.bill_days,
+        "BillType": c.bill_terms,
+        "SaleDay": c.invoice_days,
+        "SaleType": c.invoice_terms,
+    }
+
+
+def refresh_contact(request, contact):
+    """Fetch a Contact's details again in the background if they're stale
+    """
+    if contact.updated < timezone.now() - datetime.timedelta(
+            seconds=getattr(settings, 'CONTACT_MAX_AGE', 300)):
+        background.run_once(_fetch_key(contact.xero_id), fetch, request,
+                            contact.xero_id)
+
+
+def search(q, limit=50):
+    """XeroContacts with q in their names, those starting with it first
+
+    Archived contacts are left out, as Xero's own search does.  Return
+    None if contacts haven't been copied from Xero yet.
+    """
+    if not XeroContact.objects.exists():
+        return None
+    return list(XeroContact.objects
+                .filter(name__icontains=q)
+                .exclude(status='ARCHIVED')
+                .annotate(prefix=Case(When(name__istartswith=q, then=Value(0)),
+                                      default=Value(1),
+                                      output_field=IntegerField()))
+                .order_by('prefix', 'name')[:limit])
@@ -0,0 +1,137 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.test.utils import CaptureQueriesContext, override_settings
+from django.utils import timezone
+from invoicer.models import *
+from invoicer import synthetic, views
+import json
+import random
+import time
+import tracemalloc
+
+class Command(BaseCommand):
+    help = 'Benchmark the pricing code against a synthetic catalog'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--bands', type=int, default=50)
+        parser.add_argument('--products', type=int, default=5000)
+        parser.add_argument('--rules', type=int, default=50000)
+        parser.add_argument('--contacts', type=int, default=2000)
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--samples', type=int, default=500,
+                            help="Number of lines to time for each test")
+        parser.add_argument('--lines', type=int, default=20,
+                            help="Lines per invoice")
+        parser.add_argument('--existing', action='store_true',
+                            help="Use the catalog already in the database "
+                            "instead of building a synthetic one")
+        parser.add_argument('--matrix', action='store_true',
+                            help="Also build and time the price matrix")
+        parser.add_argument('--output', help="Write results as JSON here")
+
+    def handle(self, *args, **options):
+        self.rnd = random.Random(options['seed'])
+        try:
+            with transaction.atomic():
+                results = self.run(options)
+                # Never keep the synthetic catalog
+                transaction.set_rollback(True)
+        finally:
+            price_rules.invalidate()
+        for name, r in results['results'].items():
+            self.stdout.write("{:30} {}".format(name, ", ".join(
+                f"{k}={v}" for k, v in r.items())))
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                json.dump(results, f, indent=2)
+
+    def run(self, options):
+        scale = {k: options[k] for k in
+                 ('bands', 'products', 'rules', 'contacts', 'seed')}
+        results = {}
+        if options['existing']:
+            scale = {'existing': True}
+        else:
+            start = time.perf_counter()
+            synthetic.build_catalog(**scale)
+            results['build_catalog'] = {
+                'seconds': round(time.perf_counter() - start, 3)}
+        bands = list(PriceBand.objects.all())
+        units = {}
+        for u in Unit.objects.all():
+            units.setdefault(u.type_id, []).append(u)
+        products = [p for p in Product.objects.all() if p.type_id in units]
+        contacts = [None] + list(Contact.objects.all()[:500])
+        if not bands or not products:
+            raise CommandError("No price bands or products to benchmark")
+        scale.update(catalog={
+            'bands': len(bands), 'products': len(products),
+            'rules': Price.objects.count(),
+            'contacts': Contact.objects.count()})
+
+        def item():
+            p = self.rnd.choice(products)
+            return views.InvoiceItem(
+                self.rnd.randint(1, 10), self.rnd.choice(units[p.type_id]),
+                p, self.rnd.random() < 0.1, self.rnd.choice(contacts))
+
+        samples = options['samples']
+        lines = [(item(), self.rnd.choice(bands)) for i in range(samples)]
+
+        # Loading the rule index
+        price_rules.invalidate()
+        tracemalloc.start()
+        with CaptureQueriesContext(connection) as queries:
+            start = time.perf_counter()
+            price_rules.rules_for(bands[0], lines[0][0])
+            seconds = time.perf_counter() - start
+        size, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        results['rule_index_load'] = {
+            'seconds': round(seconds, 3), 'queries': len(queries),
+            'memory_kb': size // 1024, 'peak_memory_kb': peak // 1024}
+
+        results['apply_rules_for'] = synthetic.measure(
+            lambda l: l[1].apply_rules_for(l[0]), lines)
+        with override_settings(INTEGER_PRICING=True):
+            # The first use of each rule converts its amounts to pence
+            for l in lines:
+                price_many([l[0]], [l[1]])
+            results['price_many_integer'] = synthetic.measure(
+                lambda l: price_many([l[0]], [l[1]]), lines)
+        results['price_many_decimal'] = synthetic.measure(
+            lambda l: price_many([l[0]], [l[1]]), lines)
+        results['price_many_all_bands'] = synthetic.measure(
+            lambda l: price_many([l[0]], bands), lines[:50])
+
+        def invoice(l):
+            items = [item() for i in range(options['lines'])]
+            views.price_items(items, [l[1]])
+            return sum(i[l[1]].priceincvat for i in items)
+        results['invoice'] = synthetic.measure(invoice, lines[:100])
+        results['invoice']['invoices_per_second'] = round(
+            1e6 / results['invoice']['mean_us'], 1)
+
+        results['parse_item_exact'] = synthetic.measure(
+            lambda l: views.parse_item(
+                f"{l[0].items} {l[0].unit.name} {l[0].product.name}",
+                exactmatch=True), lines[:100])
+        results['parse_item_completion'] = synthetic.measure(
+            lambda l: views.parse_item(
+                f"{l[0].items} {l[0].unit.name} {l[0].product.name[:6]}"),
+            lines[:100])
+
+        if options['matrix']:
+            with override_settings(PRICE_MATRIX=True):
+                start = time.perf_counter()
+                cells = update_price_matrix()
+                results['matrix_rebuild'] = {
+                    'seconds': round(time.perf_counter() - start, 3),
+                    'cells': cells}
+                results['matrix_lookup'] = synthetic.measure(
+                    lambda l: matrix_prices([l[0]], [l[1]]), lines)
+
+        return {'timestamp': timezone.now().isoformat(),
+                'database': connection.vendor,
+                'scale': scale,
+                'results': results}
@@ -0,0 +1,56 @@
+from django.core.management.base import BaseCommand, CommandError
+from invoicer.models import *
+from invoicer.models import _apply_rules, _apply_rules_in_pence
+import time
+
+class Command(BaseCommand):
+    help = 'Check integer pence pricing against Decimal pricing for the whole catalog'
+
+    def handle(self, *args, **options):
+        bands = list(PriceBand.objects.all())
+        contacts = [None] + list(
+            Contact.objects.filter(price__isnull=False).distinct())
+        units = {}
+        for u in Unit.objects.all():
+            units.setdefault(u.type_id, []).append(u)
+        checked = 0
+        fallback = 0
+        problems = 0
+        decimal_time = 0
+        pence_time = 0
+        for product in Product.objects.all():
+            for unit in units.get(product.type_id, []):
+                for bill in (False, True):
+                    for contact in contacts:
+                        item = MatrixItem(product, unit, bill, contact)
+                        for rules in price_rules.rules_for_bands(bands, item):
+                            start = time.perf_counter()
+                            expected = _apply_rules(rules, item)
+                            decimal_time += time.perf_counter() - start
+                            start = time.perf_counter()
+                            found = _apply_rules_in_pence(rules, item)
+                            pence_time += time.perf_counter() - start
+                            checked += 1
+                            if found is None:
+                                fallback += 1
+                                continue
+                            if _describe(found) != _describe(expected):
+                                problems += 1
+                                self.stdout.write(
+                                    f"{product} {unit} "
+                                    f"{'bill' if bill else 'invoice'} "
+                                    f"{contact or ''}: {_describe(found)} "
+                                    f"should be {_describe(expected)}")
+        self.stdout.write(
+            f"Checked {checked} prices: {fallback} need Decimal arithmetic, "
+            f"{problems} problems")
+        if pence_time:
+            self.stdout.write(
+                f"Decimal {decimal_time:.3f}s, integer {pence_time:.3f}s "
+                f"({decimal_time / pence_time:.1f}x)")
+        if problems:
+            raise CommandError("Integer pricing does not match Decimal pricing")
+
+def _describe(result):
+    price, account, applied = result
+    return str(price), account, [(r.pk, s) for r, s in applied]
@@ -0,0 +1,42 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from invoicer.models import *
+from invoicer import synthetic
+import time
+
+class Command(BaseCommand):
+    help = 'Fill the database with a synthetic catalog for load testing'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--bands', type=int, default=50)
+        parser.add_argument('--products', type=int, default=5000)
+        parser.add_argument('--rules', type=int, default=50000,
+                            help="Approximate number of price rules")
+        parser.add_argument('--contacts', type=int, default=2000)
+        parser.add_argument('--seed', type=int, default=0,
+                            help="The same seed always gives the same data")
+        parser.add_argument('--prefix', default="Synthetic",
+                            help="Used in names and product codes; use a "
+                            "different prefix to add a second catalog")
+        parser.add_argument('--batch-size', type=int, default=5000)
+
+    def handle(self, *args, **options):
+        prefix = options['prefix']
+        if PriceBand.objects.filter(name__startswith=f"{prefix} band ")\
+                            .exists():
+            raise CommandError(
+                f"There is already a catalog with prefix '{prefix}'")
+        start = time.perf_counter()
+        with transaction.atomic():
+            made = synthetic.build_catalog(
+                bands=options['bands'], products=options['products'],
+                rules=options['rules'], contacts=options['contacts'],
+                seed=options['seed'], prefix=prefix,
+                batch_size=options['batch_size'])
+        self.stdout.write(
+            "Created {} bands, {} products, {} contacts and {} price rules "
+            "in {:.1f}s".format(len(made['bands']), len(made['products']),
+                                len(made['contacts']), made['rules'],
+                                time.perf_counter() - start))
+        if price_matrix_enabled():
+            self.stdout.write("Now run './manage.py pricematrix --rebuild'")
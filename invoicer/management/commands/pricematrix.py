@@ -0,0 +1,53 @@
+from django.core.management.base import BaseCommand, CommandError
+from invoicer.models import *
+
+class Command(BaseCommand):
+    help = 'Rebuild or verify the materialized price matrix'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rebuild', action='store_true',
+                            help="Recompute every cell of the matrix")
+        parser.add_argument('--verify', action='store_true',
+                            help="Check the matrix against the price rules")
+
+    def handle(self, *args, **options):
+        if not (options['rebuild'] or options['verify']):
+            raise CommandError("Specify --rebuild and/or --verify")
+        if options['rebuild']:
+            n = update_price_matrix()
+            self.stdout.write(f"Wrote {n} cells")
+        if options['verify']:
+            self.verify()
+
+    def verify(self):
+        """Compare matrix lookups with the full rule chain for every item
+        """
+        bands = list(PriceBand.objects.all())
+        contacts = [None] + list(
+            Contact.objects.filter(price__isnull=False).distinct())
+        checked = 0
+        problems = 0
+        for product in Product.objects.all():
+            items = [MatrixItem(product, unit, bill, contact)
+                     for unit in Unit.objects.filter(type=product.type)
+                     for bill in (False, True)
+                     for contact in contacts]
+            found = matrix_prices(items, bands)
+            expected = price_many(items, bands)
+            for item, frow, erow in zip(items, found, expected):
+                for band, f, e in zip(bands, frow, erow):
+                    if f is None and item.contact \
+                       and band.pk != item.contact.priceband_id:
+                        # Looked up from the rules by design
+                        continue
+                    checked += 1
+                    if f != e:
+                        problems += 1
+                        self.stdout.write(
+                            f"{product} {item.unit} {band} "
+                            f"{'bill' if item.isBill else 'invoice'} "
+                            f"{item.contact or ''}: matrix has "
+                            f"{f[0] if f else 'nothing'}, rules give {e[0]}")
+        self.stdout.write(f"Checked {checked} prices, {problems} problems")
+        if problems:
+            raise CommandError("Price matrix does not match the price rules")
@@ -0,0 +1,19 @@
+from django.core.management.base import BaseCommand, CommandError
+from oauthlib.oauth2.rfc6749.errors import OAuth2Error
+from invoicer import xero
+
+class Command(BaseCommand):
+    help = 'Refresh the Xero token if it expires soon; run this from cron'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--margin', type=int, default=None,
+                            help="Refresh if the token expires within "
+                            "this many seconds")
+
+    def handle(self, *args, **options):
+        try:
+            token = xero.refresh_token(margin=options['margin'])
+        except OAuth2Error as e:
+            raise CommandError(f"Could not refresh token: {e}")
+        if token is None:
+            raise CommandError("Not connected to Xero")
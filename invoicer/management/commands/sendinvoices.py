@@ -0,0 +1,21 @@
+from django.core.management.base import BaseCommand
+from django.conf import settings
+from invoicer import sendqueue
+import time
+
+class Command(BaseCommand):
+    help = 'Send queued invoices to Xero'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true',
+                            help="Send what is due and exit, rather than "
+                            "waiting for more")
+
+    def handle(self, *args, **options):
+        while True:
+            n = sendqueue.run_pending()
+            if n:
+                self.stdout.write(f"Tried {n} invoices")
+            if options['once']:
+                return
+            time.sleep(getattr(settings, 'SEND_QUEUE_POLL', 5))
@@ -0,0 +1,12 @@
+from django.core.management.base import BaseCommand, CommandError
+from invoicer import contacts, xero
+
+class Command(BaseCommand):
+    help = 'Copy contacts changed on Xero since the last sync'
+
+    def handle(self, *args, **options):
+        try:
+            n = contacts.sync(None)
+        except xero.Problem as e:
+            raise CommandError(e.message)
+        self.stdout.write(f"Copied {n} contacts")
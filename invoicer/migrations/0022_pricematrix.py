@@ -0,0 +1,32 @@
+# Generated by Django 3.2.25 on 2026-10-18 15:31
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('invoicer', '0021_auto_20210725_1456'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PriceMatrix',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('isBill', models.BooleanField()),
+                ('priceperbarrel', models.CharField(max_length=40)),
+                ('account', models.CharField(max_length=10)),
+                ('reasons', models.JSONField(default=list)),
+                ('band', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='invoicer.priceband')),
+                ('contact', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, to='invoicer.contact')),
+                ('product', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='invoicer.product')),
+                ('unit', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='invoicer.unit')),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='pricematrix',
+            constraint=models.UniqueConstraint(fields=('product', 'unit', 'band', 'isBill', 'contact'), name='invoicer_pricematrix_cell'),
+        ),
+    ]
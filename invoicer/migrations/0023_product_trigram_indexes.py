@@ -0,0 +1,34 @@
+from django.contrib.postgres.operations import TrigramExtension
+from django.db import migrations
+
+# The expressions match the SQL Django generates for case-insensitive
+# lookups (code is a CICharField, so code=... is one too), so that
+# name__icontains, code__icontains and code__iexact can use them.
+# The trigram indexes also serve the % (similarity) operator on
+# UPPER(name) and UPPER(code).
+#
+# Django 3.2 can't express an operator class on an index expression,
+# hence the SQL.
+
+indexes = [
+    ("invoicer_product_name_trgm",
+     "USING gin (UPPER(name::text) gin_trgm_ops)"),
+    ("invoicer_product_code_trgm",
+     "USING gin (UPPER(code::text) gin_trgm_ops)"),
+    ("invoicer_product_code_upper",
+     "(UPPER(code::text))"),
+]
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('invoicer', '0022_pricematrix'),
+    ]
+
+    operations = [
+        TrigramExtension(),
+        migrations.RunSQL(
+            [f"CREATE INDEX {name} ON invoicer_product {index}"
+             for name, index in indexes],
+            reverse_sql=[f"DROP INDEX {name}" for name, index in indexes]),
+    ]
@@ -0,0 +1,27 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('invoicer', '0023_product_trigram_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='XeroContact',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('contact_id', models.CharField(max_length=36, unique=True)),
+                ('name', models.CharField(max_length=500)),
+                ('full_name', models.CharField(blank=True, max_length=500)),
+                ('status', models.CharField(blank=True, max_length=20)),
+                ('updated', models.DateTimeField(blank=True, help_text='When the contact was last changed on Xero', null=True)),
+            ],
+        ),
+        # For name__icontains and name__istartswith; see 0023
+        migrations.RunSQL(
+            "CREATE INDEX invoicer_xerocontact_name_trgm ON invoicer_xerocontact "
+            "USING gin (UPPER(name::text) gin_trgm_ops)",
+            reverse_sql="DROP INDEX invoicer_xerocontact_name_trgm"),
+    ]
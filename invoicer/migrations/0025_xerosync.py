@@ -0,0 +1,40 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('invoicer', '0024_xerocontact'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='xerocontact',
+            name='bill_days',
+            field=models.IntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='xerocontact',
+            name='bill_terms',
+            field=models.CharField(blank=True, choices=[('DAYSAFTERBILLDATE', 'day(s) after bill date'), ('DAYSAFTERBILLMONTH', 'day(s) after bill month'), ('OFCURRENTMONTH', 'of the current month'), ('OFFOLLOWINGMONTH', 'of the following month')], max_length=20),
+        ),
+        migrations.AddField(
+            model_name='xerocontact',
+            name='invoice_days',
+            field=models.IntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='xerocontact',
+            name='invoice_terms',
+            field=models.CharField(blank=True, choices=[('DAYSAFTERBILLDATE', 'day(s) after bill date'), ('DAYSAFTERBILLMONTH', 'day(s) after bill month'), ('OFCURRENTMONTH', 'of the current month'), ('OFFOLLOWINGMONTH', 'of the following month')], max_length=20),
+        ),
+        migrations.CreateModel(
+            name='XeroSync',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=40, unique=True)),
+                ('high_water', models.DateTimeField(blank=True, null=True)),
+                ('synced', models.DateTimeField(blank=True, help_text='When the last sync finished', null=True)),
+            ],
+        ),
+    ]
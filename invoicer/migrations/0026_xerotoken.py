@@ -0,0 +1,21 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('invoicer', '0025_xerosync'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='XeroToken',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('tenant_id', models.CharField(max_length=36, unique=True)),
+                ('token', models.TextField()),
+                ('expires', models.DateTimeField(help_text='When the access token expires')),
+                ('updated', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+    ]
@@ -0,0 +1,44 @@
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('invoicer', '0026_xerotoken'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SendJob',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('contact_id', models.CharField(max_length=36)),
+                ('contact_name', models.CharField(max_length=500)),
+                ('bill', models.BooleanField(default=False)),
+                ('date', models.DateField()),
+                ('duedate', models.DateField(blank=True, null=True)),
+                ('reference', models.CharField(blank=True, max_length=255)),
+                ('lines', models.JSONField(help_text='Xero line items')),
+                ('status', models.CharField(choices=[('queued', 'Queued'), ('sending', 'Sending'), ('sent', 'Sent'), ('failed', 'Failed')], default='queued', max_length=10)),
+                ('attempts', models.IntegerField(default=0)),
+                ('next_try', models.DateTimeField(auto_now_add=True)),
+                ('invoice_id', models.CharField(blank=True, max_length=36)),
+                ('warnings', models.JSONField(blank=True, default=list)),
+                ('error', models.TextField(blank=True)),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('updated', models.DateTimeField(auto_now=True)),
+                ('products', models.ManyToManyField(blank=True, help_text='Products to send to Xero before the invoice', to='invoicer.Product')),
+                ('user', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'ordering': ['-created'],
+            },
+        ),
+        migrations.AddIndex(
+            model_name='sendjob',
+            index=models.Index(fields=['status', 'next_try'], name='invoicer_se_status_cce582_idx'),
+        ),
+    ]
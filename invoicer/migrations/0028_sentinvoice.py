@@ -0,0 +1,25 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('invoicer', '0027_sendjob'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SentInvoice',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('key', models.CharField(max_length=64, unique=True)),
+                ('invoice_id', models.CharField(max_length=36)),
+                ('created', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='sendjob',
+            name='request_key',
+            field=models.CharField(blank=True, help_text='Idempotency key of the request it was last sent in', max_length=64),
+        ),
+    ]
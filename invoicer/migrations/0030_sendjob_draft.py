@@ -0,0 +1,16 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('invoicer', '0029_indexversion'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='sendjob',
+            name='draft',
+            field=models.CharField(blank=True, help_text='The draft it was queued from; see sendqueue.new_draft', max_length=32),
+        ),
+    ]
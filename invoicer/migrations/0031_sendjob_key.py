@@ -0,0 +1,16 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('invoicer', '0030_sendjob_draft'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='sendjob',
+            name='key',
+            field=models.CharField(blank=True, db_index=True, help_text='Its xero.invoice_key, the same for jobs from one draft', max_length=64),
+        ),
+    ]
@@ -0,0 +1,29 @@
+from django.db import migrations, models
+from django.db.models import Count, Min
+
+
+def remove_duplicate_cells(apps, schema_editor):
+    PriceMatrix = apps.get_model('invoicer', 'PriceMatrix')
+    cells = PriceMatrix.objects.filter(contact__isnull=True)
+    duplicated = cells.values('product', 'unit', 'band', 'isBill')\
+                      .annotate(n=Count('pk'), keep=Min('pk'))\
+                      .filter(n__gt=1)
+    for d in duplicated:
+        cells.filter(product=d['product'], unit=d['unit'], band=d['band'],
+                     isBill=d['isBill']).exclude(pk=d['keep']).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('invoicer', '0031_sendjob_key'),
+    ]
+
+    operations = [
+        migrations.RunPython(remove_duplicate_cells,
+                             migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='pricematrix',
+            constraint=models.UniqueConstraint(condition=models.Q(('contact__isnull', True)), fields=('product', 'unit', 'band', 'isBill'), name='invoicer_pricematrix_band_cell'),
+        ),
+    ]
@@ -1,14 +1,19 @@
-from django.db import models
-from django.db.models import Q
-from decimal import Decimal, ROUND_UP
+from django.db import models, transaction
+from django.db.models import F, Q
+from django.db.models.signals import post_init, pre_save, post_save, \
+    post_delete
+from django.core.signals import request_started
+from decimal import Decimal
 from django.conf import settings
 from django.urls import reverse
-import decimal
+from django.utils.functional import cached_property
+from invoicer import programrules
+import collections
+import heapq
+import threading
+import time
 
 zero = Decimal("0.00")
-penny = Decimal("0.01")
-fifty_pence = Decimal("0.50")
-pound = Decimal("1.00")
 
 
 class CaseInsensitiveFieldMixin:
@@ -49,25 +54,61 @@ class PriceBand(models.Model):
 
         Return (price, account, list of rules)
         """
-        rules = Price.objects.\
-                filter(Q(band=self) | Q(band__isnull=True)).\
-                filter(Q(type=item.product.type) | Q(type__isnull=True)).\
-                filter(Q(abv=item.product.abv) | Q(abv__isnull=True)).\
-                filter(Q(isSwap=item.product.swap) | Q(isSwap__isnull=True)).\
-                filter(Q(isBill=item.isBill) | Q(isBill__isnull=True)).\
-                filter(Q(product=item.product) | Q(product__isnull=True)).\
-                filter(Q(unit=item.unit) | Q(unit__isnull=True)).\
-                filter(Q(contact=item.contact) | Q(contact__isnull=True)).\
-                order_by('priority').\
-                all()
-        price = zero
-        account = "undefined"
-        applied = []
-        for r in rules:
-            price, account = r.apply(item, price, account)
-            applied.append((r, f"{price} / {account}"))
-        return price, account, applied
+        return _apply_rules(price_rules.rules_for(self, item), item)
+
+
+def _apply_rules(rules, item):
+    price = zero
+    account = "undefined"
+    applied = []
+    for r in rules:
+        price, account = r.apply(item, price, account)
+        applied.append((r, f"{price} / {account}"))
+    return price, account, applied
+
+def _pounds(pence):
+    return Decimal(pence).scaleb(-2)
+
+def _pounds_str(pence):
+    # str(_pounds(pence)), without the Decimal
+    sign = "-" if pence < 0 else ""
+    pounds, pence = divmod(abs(pence), 100)
+    return f"{sign}{pounds}.{pence:02d}"
+
+def _apply_rules_in_pence(rules, item):
+    """As _apply_rules, but working in integer pence
 
+    Return None if any of the rules can't be worked out exactly in
+    pence; the caller should use _apply_rules instead.
+    """
+    pence = 0
+    account = "undefined"
+    results = []
+    for r in rules:
+        pence, account = r.apply_pence(item, pence, account)
+        if pence is None:
+            return None
+        results.append((r, pence, account))
+    return _pounds(pence), account, \
+        [(r, f"{_pounds_str(p)} / {a}") for r, p, a in results]
+
+def _apply_rules_fast(rules, item):
+    return _apply_rules_in_pence(rules, item) or _apply_rules(rules, item)
+
+def price_many(items, bands):
+    """Price a number of invoice items in a number of price bands
+
+    The candidate rules for each item are found once for all the bands.
+
+    Return a list (one entry per item) of lists (one entry per band)
+    of (price, account, list of rules) as returned by apply_rules_for.
+    """
+    bands = list(bands)
+    apply = _apply_rules_fast if getattr(settings, 'INTEGER_PRICING', False) \
+        else _apply_rules
+    return [[apply(rules, item)
+             for rules in price_rules.rules_for_bands(bands, item)]
+            for item in items]
 
 class Contact(models.Model):
     """Extra details for Xero contacts.
@@ -101,6 +142,134 @@ class Contact(models.Model):
         return reverse('invoice', args=[self.xero_id])
 
 
+class XeroContact(models.Model):
+    """A copy of a contact on Xero, for searching by name
+
+    Every Xero contact has one of these, whether or not it has a
+    Contact; see invoicer.contacts.
+    """
+    contact_id = models.CharField(max_length=36, unique=True) # uuid
+    name = models.CharField(max_length=500) # xero max is 500
+    full_name = models.CharField(max_length=500, blank=True)
+    status = models.CharField(max_length=20, blank=True)
+    updated = models.DateTimeField(null=True, blank=True,
+                                   help_text="When the contact was last "
+                                   "changed on Xero")
+    bill_days = models.IntegerField(null=True, blank=True)
+    bill_terms = models.CharField(max_length=20, choices=Contact.TERMS_CHOICES,
+                                  blank=True)
+    invoice_days = models.IntegerField(null=True, blank=True)
+    invoice_terms = models.CharField(max_length=20,
+                                     choices=Contact.TERMS_CHOICES,
+                                     blank=True)
+
+    def __str__(self):
+        return self.name
+
+
+class XeroSync(models.Model):
+    """How far copying something from Xero has got
+
+    high_water is the latest change on Xero that has been copied; the
+    next sync asks only for changes since then.
+    """
+    name = models.CharField(max_length=40, unique=True)
+    high_water = models.DateTimeField(null=True, blank=True)
+    synced = models.DateTimeField(null=True, blank=True,
+                                  help_text="When the last sync finished")
+
+    def __str__(self):
+        return self.name
+
+
+class XeroToken(models.Model):
+    """The OAuth token for a Xero organisation, shared by all users
+
+    The token is encrypted with a key derived from SECRET_KEY; see
+    invoicer.xero.
+    """
+    tenant_id = models.CharField(max_length=36, unique=True) # uuid
+    token = models.TextField()
+    expires = models.DateTimeField(help_text="When the access token "
+                                   "expires")
+    updated = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return self.tenant_id
+
+
+class SendJob(models.Model):
+    """An invoice or bill waiting to be sent to Xero, or sent
+
+    The lines are priced when the job is queued, as Xero line items;
+    see invoicer.sendqueue.
+    """
+    QUEUED = 'queued'
+    SENDING = 'sending'
+    SENT = 'sent'
+    FAILED = 'failed'
+    STATUS_CHOICES = (
+        (QUEUED, 'Queued'),
+        (SENDING, 'Sending'),
+        (SENT, 'Sent'),
+        (FAILED, 'Failed'),
+    )
+    contact_id = models.CharField(max_length=36) # uuid
+    contact_name = models.CharField(max_length=500)
+    bill = models.BooleanField(default=False)
+    date = models.DateField()
+    duedate = models.DateField(null=True, blank=True)
+    reference = models.CharField(max_length=255, blank=True)
+    lines = models.JSONField(help_text="Xero line items")
+    draft = models.CharField(
+        max_length=32, blank=True,
+        help_text="The draft it was queued from; see sendqueue.new_draft")
+    key = models.CharField(
+        max_length=64, blank=True, db_index=True,
+        help_text="Its xero.invoice_key, the same for jobs from one draft")
+    products = models.ManyToManyField(
+        'Product', blank=True,
+        help_text="Products to send to Xero before the invoice")
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, null=True,
+                             blank=True, on_delete=models.SET_NULL)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES,
+                              default=QUEUED)
+    attempts = models.IntegerField(default=0)
+    next_try = models.DateTimeField(auto_now_add=True)
+    invoice_id = models.CharField(max_length=36, blank=True)
+    request_key = models.CharField(
+        max_length=64, blank=True,
+        help_text="Idempotency key of the request it was last sent in")
+    warnings = models.JSONField(default=list, blank=True)
+    error = models.TextField(blank=True)
+    created = models.DateTimeField(auto_now_add=True)
+    updated = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['status', 'next_try']),
+        ]
+        ordering = ['-created']
+
+    def __str__(self):
+        return "{} {} for {}".format(
+            "Bill" if self.bill else "Invoice", self.pk, self.contact_name)
+
+
+class SentInvoice(models.Model):
+    """An invoice or bill that Xero has accepted
+
+    The key is from xero.invoice_key, so the same draft of an invoice
+    isn't sent twice.
+    """
+    key = models.CharField(max_length=64, unique=True)
+    invoice_id = models.CharField(max_length=36)
+    created = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return self.invoice_id
+
+
 class ProductType(models.Model):
     """Type of product, eg. real ale or craft keg
     """
@@ -142,28 +311,6 @@ class Product(models.Model):
         return reverse('edit-product', args=[self.pk])
 
 
-def _round_up_to(amount, multiple):
-    difference = amount % multiple
-    if difference:
-        amount = amount + multiple - difference
-    return amount
-
-def _vatinc_roundup_adjustment(item, current_price, multiple):
-    vatinc_price = item.unit.size * current_price * settings.VAT_MULTIPLIER
-    desired_price = _round_up_to(vatinc_price, multiple)
-    difference_inc_vat = desired_price - vatinc_price
-    difference_ex_vat = difference_inc_vat / settings.VAT_MULTIPLIER
-    difference_per_barrel = difference_ex_vat / item.unit.size
-    adjustment = difference_per_barrel.quantize(penny)
-    return adjustment
-
-def _round_item_up_to(item, current_price, multiple):
-    item_price = item.unit.size * current_price
-    rounded_item_price = _round_up_to(item_price, multiple)
-    rounded_barrel_price = rounded_item_price / item.unit.size
-    return rounded_barrel_price
-
-
 class ProgramRule(models.Model):
     """A pricing rule implemented in code"""
     name = models.CharField(max_length=80, unique=True)
@@ -172,28 +319,22 @@ class ProgramRule(models.Model):
     def __str__(self):
         return self.name
 
+    @cached_property
+    def implementation(self):
+        """The rule for this code from the registry, with parameters parsed
+        """
+        return programrules.resolve(self.code)
+
     def apply(self, item, price, account):
-        if self.code == "vat-roundup-pound":
-            price = price + _vatinc_roundup_adjustment(
-                item, price, pound)
-        elif self.code == "vat-roundup-50p":
-            price = price + _vatinc_roundup_adjustment(
-                item, price, fifty_pence)
-        elif self.code == "barrel-roundup-pound":
-            price = _round_up_to(price, pound)
-        elif self.code == "item-roundup-pound":
-            price = _round_item_up_to(item, price, pound)
-        elif self.code == "item-roundup-50p":
-            price = _round_item_up_to(item, price, fifty_pence)
-        elif self.code == "multiply-by-abv":
-            price = (price * item.product.abv).quantize(penny)
-        elif self.code.startswith("multiply-by-"):
-            try:
-                price = (price * Decimal(self.code[12:])).quantize(penny)
-            except decimal.InvalidOperation:
-                pass
+        return self.implementation.apply(item, price, account)
 
-        return price, account
+    def apply_pence(self, item, pence, account):
+        """As apply, with the price in integer pence
+
+        The price returned is None if the rule can't be applied exactly
+        in pence.
+        """
+        return self.implementation.apply_pence(item, pence, account)
 
 
 class Price(models.Model):
@@ -288,3 +429,496 @@ class Price(models.Model):
         if self.account:
             account = self.account
         return price, account
+
+    @cached_property
+    def _pence(self):
+        """(amount to add, new price, rule function, account) in pence
+
+        None if the amounts aren't whole numbers of pence.
+        """
+        price = programrules.to_pence(self.price) if self.price else 0
+        absolute_price = programrules.to_pence(self.absolute_price) \
+            if self.absolute_price else None
+        if price is None or (self.absolute_price and absolute_price is None):
+            return None
+        return (price, absolute_price,
+                self.rule.implementation if self.rule_id else None,
+                self.account)
+
+    def apply_pence(self, item, pence, account):
+        """As apply, with the price in integer pence (or None)"""
+        compiled = self._pence
+        if compiled is None:
+            return None, account
+        price, absolute_price, rule, new_account = compiled
+        pence = pence + price
+        if absolute_price is not None:
+            pence = absolute_price
+        if rule:
+            pence, account = rule.apply_pence(item, pence, account)
+        if new_account:
+            account = new_account
+        return pence, account
+
+
+class PriceMatrix(models.Model):
+    """The result of the price rules for a product unit in a price band
+
+    This is derived entirely from the Price rules, and is only kept up
+    to date while settings.PRICE_MATRIX is set.  Rows with a contact
+    exist only where one of that contact's own rules applies.
+    """
+    product = models.ForeignKey(Product, on_delete=models.CASCADE)
+    unit = models.ForeignKey(Unit, on_delete=models.CASCADE)
+    band = models.ForeignKey(PriceBand, on_delete=models.CASCADE)
+    isBill = models.BooleanField()
+    contact = models.ForeignKey(Contact, blank=True, null=True,
+                                on_delete=models.CASCADE)
+    # Kept as text: the item rounding rules can leave the price per
+    # barrel with more decimal places than a DecimalField would keep
+    priceperbarrel = models.CharField(max_length=40)
+    account = models.CharField(max_length=10)
+    # List of (Price pk, intermediate result) pairs
+    reasons = models.JSONField(default=list)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=['product', 'unit', 'band', 'isBill', 'contact'],
+                name='invoicer_pricematrix_cell'),
+            # NULLs are distinct in the constraint above
+            models.UniqueConstraint(
+                fields=['product', 'unit', 'band', 'isBill'],
+                condition=models.Q(contact__isnull=True),
+                name='invoicer_pricematrix_band_cell'),
+        ]
+
+    def __str__(self):
+        return f"{self.product} {self.unit} {self.band}: " \
+            f"{self.priceperbarrel} / {self.account}"
+
+
+class IndexVersion(models.Model):
+    """How many times something kept in memory has been changed
+
+    Each MemoryIndex has one; see check_index_versions.
+    update_price_matrix locks one to take its turn.
+    """
+    name = models.CharField(max_length=40, unique=True)
+    version = models.IntegerField(default=0)
+
+    def __str__(self):
+        return f"{self.name} {self.version}"
+
+
+class MemoryIndex:
+    """Something worked out from the database and kept in memory
+
+    Subclasses implement _load, which returns whatever is kept, and
+    look it up with _current.  It is discarded by invalidate, which
+    also counts the change in the IndexVersion called version_key.
+    Other processes notice the new version when they next call
+    check_index_versions, at the start of each request, and in any
+    case reload after max_age seconds.
+    """
+    version_key = None
+    max_age_setting = None
+    instances = []
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._data = None
+        self._generation = 0
+        self._loaded = 0
+        # The version the data was loaded at, and the latest seen
+        self._version = None
+        self._latest = None
+        MemoryIndex.instances.append(self)
+
+    @property
+    def max_age(self):
+        return getattr(settings, self.max_age_setting, 300)
+
+    def invalidate(self, local_only=False):
+        self._generation += 1
+        self._data = None
+        if not local_only:
+            # Inside a transaction this commits along with the change
+            if not IndexVersion.objects.filter(name=self.version_key)\
+                                       .update(version=F('version') + 1):
+                IndexVersion.objects.get_or_create(name=self.version_key,
+                                                   defaults={'version': 1})
+
+    def _load(self):
+        raise NotImplementedError
+
+    def _current(self):
+        version = self._latest
+        data = self._data
+        if data is not None and version == self._version \
+           and time.monotonic() - self._loaded < self.max_age:
+            return data
+        with self._lock:
+            if self._data is not None and version == self._version \
+               and time.monotonic() - self._loaded < self.max_age:
+                return self._data
+            generation = self._generation
+            data = self._load()
+            if generation == self._generation:
+                self._data = data
+                self._version = version
+                self._loaded = time.monotonic()
+            return data
+
+
+class _PriceRuleIndex(MemoryIndex):
+    """All Price rules, held in memory and bucketed by criteria
+
+    The rules are loaded, along with everything needed to apply and
+    describe them, in a single query the first time they are needed.
+    They are bucketed by band, product, contact and ABV; the remaining
+    criteria are checked as the buckets are merged in priority order.
+
+    The index is discarded whenever a rule or anything a rule refers
+    to is saved or deleted.
+    """
+    version_key = 'invoicer-price-rules-version'
+    max_age_setting = 'PRICE_RULE_INDEX_MAX_AGE'
+
+    def _load(self):
+        buckets = {}
+        by_pk = {}
+        contacts = set()
+        rules = Price.objects\
+                     .select_related('band', 'type', 'product', 'unit',
+                                     'contact', 'rule')\
+                     .order_by('priority', 'pk')
+        for r in rules:
+            key = (r.band_id, r.product_id, r.contact_id, r.abv)
+            # Plain tuples: much quicker to sort and test than model
+            # attributes.  (priority, pk) is unique, so r is never compared.
+            buckets.setdefault(key, []).append(
+                (r.priority, r.pk, r.type_id, r.isSwap, r.isBill, r.unit_id,
+                 r.band_id, r))
+            by_pk[r.pk] = r
+            if r.contact_id:
+                contacts.add(r.contact_id)
+        return buckets, by_pk, frozenset(contacts)
+
+    def rule(self, pk):
+        """The Price rule with this primary key, or None"""
+        return self._current()[1].get(pk)
+
+    def contact_has_rules(self, contact_id):
+        return contact_id in self._current()[2]
+
+    def mentions_contact(self, contact_id):
+        data = self._data
+        return data is not None and contact_id in data[2]
+
+    def _candidates(self, band_ids, item):
+        buckets = self._current()[0]
+        product = item.product
+        contact_id = item.contact.pk if item.contact else None
+        lists = []
+        for b in band_ids:
+            for p in {product.pk, None}:
+                for c in {contact_id, None}:
+                    for a in (product.abv, None):
+                        l = buckets.get((b, p, c, a))
+                        if l:
+                            lists.append(l)
+        if len(lists) == 1:
+            candidates = lists[0]
+        else:
+            candidates = heapq.merge(*lists)
+        type_id = product.type_id
+        swap = product.swap
+        isBill = item.isBill
+        unit_id = item.unit.pk
+        return [(e[6], e[7]) for e in candidates
+                if (e[2] is None or e[2] == type_id)
+                and (e[3] is None or e[3] == swap)
+                and (e[4] is None or e[4] == isBill)
+                and (e[5] is None or e[5] == unit_id)]
+
+    def rules_for(self, band, item):
+        """Price rules matching an invoice item in a band, in priority order
+        """
+        return [r for b, r in self._candidates({band.pk, None}, item)]
+
+    def rules_for_bands(self, bands, item):
+        """Price rules matching an invoice item in each of a list of bands
+        """
+        candidates = self._candidates({b.pk for b in bands} | {None}, item)
+        return [[r for b, r in candidates if b is None or b == band.pk]
+                for band in bands]
+
+price_rules = _PriceRuleIndex()
+
+
+def check_index_versions(**kwargs):
+    """Discard indexes that other processes have changed since they loaded
+
+    This is one query, made at the start of each request.
+    """
+    versions = dict(IndexVersion.objects.values_list('name', 'version'))
+    for index in MemoryIndex.instances:
+        index._latest = versions.get(index.version_key, 0)
+
+request_started.connect(check_index_versions)
+
+
+def changes_indexes(update_fields):
+    """Could saving update_fields change anything kept in memory?
+
+    Whether a product has been sent to Xero isn't kept, so a save of
+    only that (as after each invoice) leaves the indexes alone.
+    """
+    return not update_fields or not set(update_fields) <= {'sent'}
+
+def _rules_changed(sender, **kwargs):
+    if not changes_indexes(kwargs.get('update_fields')):
+        return
+    price_rules.invalidate()
+    # Anything loaded while the change was uncommitted is out of date
+    # as soon as it commits.
+    transaction.on_commit(lambda: price_rules.invalidate(local_only=True))
+
+def _contact_changed(sender, instance, **kwargs):
+    # Contacts are saved on every invoice update; only their names are
+    # used by the index, and only for contacts that have rules.
+    if price_rules.mentions_contact(instance.pk):
+        _rules_changed(sender)
+
+for _model in (Price, ProgramRule, Product, Unit, PriceBand, ProductType):
+    post_save.connect(_rules_changed, sender=_model)
+    post_delete.connect(_rules_changed, sender=_model)
+post_save.connect(_contact_changed, sender=Contact)
+post_delete.connect(_contact_changed, sender=Contact)
+
+
+# Enough of an InvoiceItem for the price rules to be applied to
+MatrixItem = collections.namedtuple('MatrixItem',
+                                    ['product', 'unit', 'isBill', 'contact'])
+
+_price_criteria = ('band_id', 'type_id', 'abv', 'isSwap', 'isBill',
+                   'product_id', 'unit_id', 'contact_id')
+
+def _criteria_of(price):
+    return {c: getattr(price, c) for c in _price_criteria}
+
+def price_matrix_enabled():
+    return getattr(settings, 'PRICE_MATRIX', False)
+
+@transaction.atomic
+def update_price_matrix(band_id=None, type_id=None, abv=None, isSwap=None,
+                        isBill=None, product_id=None, unit_id=None,
+                        contact_id=None):
+    """Recompute the PriceMatrix cells a price rule could match
+
+    The arguments are the criteria of the rule; with no arguments the
+    whole matrix is rebuilt.  Return the number of cells written.
+
+    Rows for a contact are only kept for the contact's own price band.
+    Updates take turns, each with the rules as they were at its turn,
+    so that updates for changes committed together don't both write
+    the same cells.
+    """
+    IndexVersion.objects.select_for_update().get_or_create(
+        name='invoicer-price-matrix')
+    check_index_versions()
+    cells = PriceMatrix.objects.all()
+    products = Product.objects.all()
+    units = Unit.objects.all()
+    bands = PriceBand.objects.all()
+    bills = [False, True]
+    if band_id is not None:
+        cells = cells.filter(band_id=band_id)
+        bands = bands.filter(pk=band_id)
+    if type_id is not None:
+        cells = cells.filter(product__type_id=type_id)
+        products = products.filter(type_id=type_id)
+    if abv is not None:
+        cells = cells.filter(product__abv=abv)
+        products = products.filter(abv=abv)
+    if isSwap is not None:
+        cells = cells.filter(product__swap=isSwap)
+        products = products.filter(swap=isSwap)
+    if isBill is not None:
+        cells = cells.filter(isBill=isBill)
+        bills = [isBill]
+    if product_id is not None:
+        cells = cells.filter(product_id=product_id)
+        products = products.filter(pk=product_id)
+    if unit_id is not None:
+        cells = cells.filter(unit_id=unit_id)
+        units = units.filter(pk=unit_id)
+    if contact_id is not None:
+        cells = cells.filter(contact_id=contact_id)
+        contacts = list(Contact.objects.filter(pk=contact_id))
+    else:
+        contacts = [None] + list(
+            Contact.objects.filter(price__isnull=False).distinct())
+    bands = list(bands)
+    units_by_type = {}
+    for u in units:
+        units_by_type.setdefault(u.type_id, []).append(u)
+
+    cells.delete()
+    new = []
+    written = 0
+    for p in products:
+        for u in units_by_type.get(p.type_id, []):
+            for bill in bills:
+                for c in contacts:
+                    item = MatrixItem(p, u, bill, c)
+                    if c:
+                        cbands = [b for b in bands if b.pk == c.priceband_id]
+                    else:
+                        cbands = bands
+                    for band, rules in zip(
+                            cbands, price_rules.rules_for_bands(cbands, item)):
+                        if c and not any(r.contact_id for r in rules):
+                            # The contact's own rules don't apply here
+                            continue
+                        price, account, applied = _apply_rules(rules, item)
+                        new.append(PriceMatrix(
+                            product=p, unit=u, band=band, isBill=bill,
+                            contact=c, priceperbarrel=str(price),
+                            account=account,
+                            reasons=[(r.pk, s) for r, s in applied]))
+        if len(new) >= 1000:
+            PriceMatrix.objects.bulk_create(new)
+            written += len(new)
+            new = []
+    PriceMatrix.objects.bulk_create(new)
+    return written + len(new)
+
+def matrix_prices(items, bands):
+    """Look up invoice items in the PriceMatrix
+
+    Return results in the same form as price_many, with None for cells
+    that are missing from the matrix or refer to rules that no longer
+    exist, and for contacts with rules outside their own price band.
+    """
+    items = list(items)
+    bands = list(bands)
+    if not items or not bands:
+        return [[None] * len(bands) for i in items]
+    contacts = {i.contact.pk for i in items if i.contact}
+    cells = PriceMatrix.objects\
+                       .filter(product__in={i.product.pk for i in items})\
+                       .filter(unit__in={i.unit.pk for i in items})\
+                       .filter(band__in=bands)\
+                       .filter(isBill__in={i.isBill for i in items})\
+                       .filter(Q(contact__isnull=True) |
+                               Q(contact__in=contacts))
+    found = {(c.product_id, c.unit_id, c.band_id, c.isBill, c.contact_id): c
+             for c in cells}
+    results = []
+    for i in items:
+        row = []
+        for b in bands:
+            key = (i.product.pk, i.unit.pk, b.pk, i.isBill)
+            if i.contact and b.pk != i.contact.priceband_id \
+               and price_rules.contact_has_rules(i.contact.pk):
+                cell = None
+            else:
+                cell = found.get(key + (i.contact.pk if i.contact else None,))\
+                    or found.get(key + (None,))
+            row.append(_matrix_result(cell))
+        results.append(row)
+    return results
+
+def _matrix_result(cell):
+    if cell is None:
+        return None
+    applied = []
+    for pk, s in cell.reasons:
+        r = price_rules.rule(pk)
+        if r is None:
+            return None
+        applied.append((r, s))
+    return Decimal(cell.priceperbarrel), cell.account, applied
+
+
+_matrix_pending = threading.local()
+
+def _merge_criteria(a, b):
+    """Criteria matching everything that either a or b does"""
+    return {c: a.get(c) if a.get(c) == b.get(c) else None
+            for c in _price_criteria}
+
+def _schedule_matrix_update(**criteria):
+    # Everything changed in a transaction is recomputed in one update,
+    # once it has committed and cascaded deletions have finished.
+    pending = getattr(_matrix_pending, 'criteria', None)
+    _matrix_pending.criteria = criteria if pending is None \
+        else _merge_criteria(pending, criteria)
+    transaction.on_commit(_update_pending_matrix)
+
+def _update_pending_matrix():
+    # The first of the transaction's callbacks makes the update
+    criteria = getattr(_matrix_pending, 'criteria', None)
+    _matrix_pending.criteria = None
+    if criteria is not None:
+        update_price_matrix(**criteria)
+
+def _price_pre_save(sender, instance, **kwargs):
+    if price_matrix_enabled() and instance.pk:
+        instance._matrix_criteria = Price.objects\
+                                         .filter(pk=instance.pk)\
+                                         .values(*_price_criteria)\
+                                         .first()
+
+def _price_saved(sender, instance, **kwargs):
+    if not price_matrix_enabled():
+        return
+    old = getattr(instance, '_matrix_criteria', None)
+    new = _criteria_of(instance)
+    if old and old != new:
+        _schedule_matrix_update(**old)
+    _schedule_matrix_update(**new)
+
+def _price_deleted(sender, instance, **kwargs):
+    if price_matrix_enabled():
+        _schedule_matrix_update(**_criteria_of(instance))
+
+def _programrule_saved(sender, instance, **kwargs):
+    if price_matrix_enabled():
+        for p in instance.price_set.all():
+            _schedule_matrix_update(**_criteria_of(p))
+
+def _product_saved(sender, instance, update_fields=None, **kwargs):
+    if price_matrix_enabled() and changes_indexes(update_fields):
+        _schedule_matrix_update(product_id=instance.pk)
+
+def _unit_saved(sender, instance, **kwargs):
+    if price_matrix_enabled():
+        _schedule_matrix_update(unit_id=instance.pk)
+
+def _priceband_saved(sender, instance, created, **kwargs):
+    if price_matrix_enabled() and created:
+        _schedule_matrix_update(band_id=instance.pk)
+
+def _contact_loaded(sender, instance, **kwargs):
+    instance._matrix_priceband = instance.priceband_id
+
+def _contact_saved(sender, instance, **kwargs):
+    if price_matrix_enabled() \
+       and instance.priceband_id != instance._matrix_priceband \
+       and price_rules.contact_has_rules(instance.pk):
+        _schedule_matrix_update(contact_id=instance.pk)
+    instance._matrix_priceband = instance.priceband_id
+
+# Deletions of everything else cascade to the matrix
+pre_save.connect(_price_pre_save, sender=Price)
+post_save.connect(_price_saved, sender=Price)
+post_delete.connect(_price_deleted, sender=Price)
+post_save.connect(_programrule_saved, sender=ProgramRule)
+post_save.connect(_product_saved, sender=Product)
+post_save.connect(_unit_saved, sender=Unit)
+post_save.connect(_priceband_saved, sender=PriceBand)
+post_init.connect(_contact_loaded, sender=Contact)
+post_save.connect(_contact_saved, sender=Contact)
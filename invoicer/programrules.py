@@ -0,0 +1,241 @@
+"""Implementations of ProgramRule codes
+
+A ProgramRule names a code; the code is looked up here once and the
+resulting Rule is kept with the ProgramRule.  Other apps can add rules
+without touching the models:
+
+    from invoicer.programrules import Rule, register
+
+    @register("add-duty")
+    class AddDuty(Rule):
+        def apply(self, item, price, account):
+            return price + duty_for(item), account
+
+Codes registered with prefix=True match any code starting with them;
+the rest of the code is passed to the rule as its parameter.  Exact
+codes are tried before prefixes, longest prefix first.
+"""
+from decimal import Decimal
+from django.conf import settings
+import decimal
+import functools
+
+penny = Decimal("0.01")
+fifty_pence = Decimal("0.50")
+pound = Decimal("1.00")
+
+_codes = {}
+# (prefix, Rule class) pairs, longest prefix first
+_prefixes = []
+
+
+def register(code, prefix=False):
+    """Class decorator registering a Rule for a code or code prefix"""
+    def decorator(cls):
+        if prefix:
+            _prefixes[:] = sorted(
+                [r for r in _prefixes if r[0] != code] + [(code, cls)],
+                key=lambda r: len(r[0]), reverse=True)
+        else:
+            _codes[code] = cls
+        return cls
+    return decorator
+
+
+def resolve(code):
+    """The Rule for a code, with its parameter parsed"""
+    if code in _codes:
+        return _codes[code]("")
+    for p, cls in _prefixes:
+        if code.startswith(p):
+            return cls(code[len(p):])
+    return Rule("")
+
+
+class Rule:
+    """A pricing rule implemented in code
+
+    param is whatever followed the prefix in the code, for rules
+    registered with prefix=True.  The base class leaves the price
+    alone.
+    """
+    def __init__(self, param):
+        self.param = param
+
+    def apply(self, item, price, account):
+        """Return (price, account) after applying the rule"""
+        return price, account
+
+    def apply_pence(self, item, pence, account):
+        """As apply, with the price in integer pence
+
+        Return None as the price if the rule can't be worked out
+        exactly in pence; the caller will use apply instead.  Rules
+        that don't override this are always worked out in Decimal.
+        """
+        if type(self).apply is not Rule.apply:
+            return None, account
+        return pence, account
+
+
+def _round_up_to(amount, multiple):
+    difference = amount % multiple
+    if difference:
+        amount = amount + multiple - difference
+    return amount
+
+def _vatinc_roundup_adjustment(item, current_price, multiple):
+    vatinc_price = item.unit.size * current_price * settings.VAT_MULTIPLIER
+    desired_price = _round_up_to(vatinc_price, multiple)
+    difference_inc_vat = desired_price - vatinc_price
+    difference_ex_vat = difference_inc_vat / settings.VAT_MULTIPLIER
+    difference_per_barrel = difference_ex_vat / item.unit.size
+    adjustment = difference_per_barrel.quantize(penny)
+    return adjustment
+
+def _round_item_up_to(item, current_price, multiple):
+    item_price = item.unit.size * current_price
+    rounded_item_price = _round_up_to(item_price, multiple)
+    rounded_barrel_price = rounded_item_price / item.unit.size
+    return rounded_barrel_price
+
+# Integer versions of the above.  Amounts are scaled integers; the
+# results must be exactly those of the Decimal versions.
+
+@functools.lru_cache(maxsize=1024)
+def _fixed(d):
+    """Return (n, places) with d == n / 10**places, or None if d is not finite
+    """
+    if not d.is_finite():
+        return None
+    exp = d.as_tuple().exponent
+    if exp >= 0:
+        return int(d), 0
+    return int(d.scaleb(-exp)), -exp
+
+def to_pence(amount):
+    """amount in integer pence, or None if it isn't a whole number of pence
+    """
+    f = _fixed(amount)
+    if f is None or f[1] > 2:
+        return None
+    return f[0] * 10 ** (2 - f[1])
+
+def _div_half_even(n, d):
+    """n / d rounded to an integer as by quantize(), for d > 0"""
+    q, r = divmod(n, d)
+    if 2 * r > d or (2 * r == d and q % 2):
+        q += 1
+    return q
+
+def _round_up_to_int(amount, multiple):
+    # The remainder of a Decimal division has the sign of the dividend
+    difference = abs(amount) % multiple
+    if amount < 0:
+        difference = -difference
+    if difference:
+        amount = amount + multiple - difference
+    return amount
+
+def _vatinc_roundup_adjustment_pence(item, current_pence, multiple_pence):
+    size, size_places = _fixed(item.unit.size)
+    vat, vat_places = _fixed(settings.VAT_MULTIPLIER)
+    # In units of 10**-(2 + size_places + vat_places) pounds
+    vatinc_price = size * current_pence * vat
+    desired_price = _round_up_to_int(
+        vatinc_price, multiple_pence * 10 ** (size_places + vat_places))
+    difference_inc_vat = desired_price - vatinc_price
+    return _div_half_even(difference_inc_vat, vat * size)
+
+def _multiply_pence(pence, factor):
+    if factor is None:
+        return None
+    n, places = factor
+    return _div_half_even(pence * n, 10 ** places)
+
+
+class _VatRoundup(Rule):
+    """Round the price of an item including VAT up to a multiple"""
+
+    def apply(self, item, price, account):
+        return price + _vatinc_roundup_adjustment(
+            item, price, self.multiple), account
+
+    def apply_pence(self, item, pence, account):
+        return pence + _vatinc_roundup_adjustment_pence(
+            item, pence, self.multiple_pence), account
+
+@register("vat-roundup-pound")
+class VatRoundupPound(_VatRoundup):
+    multiple = pound
+    multiple_pence = 100
+
+@register("vat-roundup-50p")
+class VatRoundup50p(_VatRoundup):
+    multiple = fifty_pence
+    multiple_pence = 50
+
+
+@register("barrel-roundup-pound")
+class BarrelRoundupPound(Rule):
+    def apply(self, item, price, account):
+        return _round_up_to(price, pound), account
+
+    def apply_pence(self, item, pence, account):
+        return _round_up_to_int(pence, 100), account
+
+
+class _ItemRoundup(Rule):
+    """Round the price of an item up to a multiple
+
+    These leave fractions of a penny in the price per barrel, so have
+    no integer version.
+    """
+
+    def apply(self, item, price, account):
+        return _round_item_up_to(item, price, self.multiple), account
+
+@register("item-roundup-pound")
+class ItemRoundupPound(_ItemRoundup):
+    multiple = pound
+
+@register("item-roundup-50p")
+class ItemRoundup50p(_ItemRoundup):
+    multiple = fifty_pence
+
+
+@register("multiply-by-abv")
+class MultiplyByABV(Rule):
+    def apply(self, item, price, account):
+        return (price * item.product.abv).quantize(penny), account
+
+    def apply_pence(self, item, pence, account):
+        return _multiply_pence(pence, _fixed(item.product.abv)), account
+
+
+@register("multiply-by-", prefix=True)
+class MultiplyBy(Rule):
+    """Multiply by the number following the prefix
+
+    Codes where that isn't a number leave the price alone.
+    """
+    def __init__(self, param):
+        super().__init__(param)
+        try:
+            self.factor = Decimal(param)
+        except decimal.InvalidOperation:
+            self.factor = None
+        self.fixed = _fixed(self.factor) if self.factor is not None else None
+
+    def apply(self, item, price, account):
+        if self.factor is not None:
+            try:
+                price = (price * self.factor).quantize(penny)
+            except decimal.InvalidOperation:
+                pass
+        return price, account
+
+    def apply_pence(self, item, pence, account):
+        if self.factor is not None:
+            pence = _multiply_pence(pence, self.fixed)
+        return pence, account
@@ -0,0 +1,297 @@
+"""Products and units, indexed in memory for parsing item descriptions
+
+Product names and codes are case-folded and split into n-grams, by
+product type; a substring search looks up the rarest n-gram of what
+was typed and only checks the products it lists.  Units are looked up
+in a table of every prefix of their names.
+
+For completions, products are also ranked by how closely they match:
+those containing what was typed come first, then those sharing enough
+n-grams with it and within a few edits of part of their name or code.
+
+The index is loaded in two queries when first needed, and discarded
+whenever a product, unit or product type is saved or deleted, by any
+process; see MemoryIndex.
+
+With settings.PRODUCT_SEARCH = "database" the same lookups are made
+in PostgreSQL instead, using the trigram indexes on Product.
+"""
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Q
+from django.db.models.functions import Greatest, Upper
+from django.db.models.signals import post_save, post_delete
+from invoicer.models import MemoryIndex, Product, ProductType, Unit, \
+    changes_indexes
+import collections
+import heapq
+
+
+def fold(s):
+    return s.casefold()
+
+def _grams(s):
+    """The n-grams looked up for a search string"""
+    if len(s) < 3:
+        return [s]
+    return [s[i:i + 3] for i in range(len(s) - 2)]
+
+def _all_grams(s):
+    """Every n-gram a search string could be looked up by"""
+    grams = {s[i:i + 3] for i in range(len(s) - 2)}
+    grams.update(s[i:i + 2] for i in range(len(s) - 1))
+    return grams
+
+def _substring_distance(pattern, text):
+    """Fewest edits turning pattern into some part of text
+
+    Myers' bit-parallel algorithm, with a bit per character of pattern.
+    """
+    peq = {}
+    for i, c in enumerate(pattern):
+        peq[c] = peq.get(c, 0) | (1 << i)
+    m = len(pattern)
+    mask = (1 << m) - 1
+    last = 1 << (m - 1)
+    pv, mv = mask, 0
+    score = best = m
+    for c in text:
+        eq = peq.get(c, 0)
+        xv = eq | mv
+        xh = (((eq & pv) + pv) ^ pv) | eq
+        ph = mv | (~(xh | pv) & mask)
+        mh = pv & xh
+        if ph & last:
+            score += 1
+        elif mh & last:
+            score -= 1
+            if score < best:
+                best = score
+        ph = (ph << 1) & mask
+        mh = (mh << 1) & mask
+        pv = mh | (~(xv | ph) & mask)
+        mv = ph & xv
+    return best
+
+
+class _TypeIndex:
+    """The products of one type"""
+    def __init__(self):
+        self.products = []
+        self.names = []
+        self.codes = []
+        self.text = []
+        self.sizes = []
+        self.by_name = {}
+        self.postings = {}
+
+    def add(self, product):
+        n = len(self.products)
+        name = fold(product.name)
+        code = fold(product.code)
+        grams = _all_grams(name) | _all_grams(code)
+        self.products.append(product)
+        self.names.append(name)
+        self.codes.append(code)
+        self.sizes.append(len(grams))
+        # Item descriptions can't contain a NUL, so can't match across it
+        self.text.append(name + "\0" + code)
+        self.by_name[product.name] = product
+        for g in grams:
+            self.postings.setdefault(g, []).append(n)
+
+    def containing(self, text):
+        """Products whose name or code contains text, case-insensitively
+
+        They are returned in the order of the Product model.
+        """
+        text = fold(text)
+        shortest = min((self.postings.get(g, ()) for g in _grams(text)),
+                       key=len)
+        return [self.products[n] for n in shortest if text in self.text[n]]
+
+    def ranked(self, text, limit):
+        """Up to limit (rank, product) pairs for products like text
+
+        A lower rank is a better match.  Products whose code is text
+        come first, then other products containing text, those with
+        the shortest names and codes first.  After those come products
+        within a few edits of text, nearest first, and then those
+        sharing the most n-grams with it.  Swap products come after
+        others that match as well.
+        """
+        text = fold(text)
+        shortest = min((self.postings.get(g, ()) for g in _grams(text)),
+                       key=len)
+        found = heapq.nsmallest(limit, (
+            ((self.codes[n] != text, 0, 0, self.sizes[n],
+              self.products[n].swap, n), self.products[n])
+            for n in shortest if text in self.text[n]), key=lambda r: r[0])
+        max_edits = len(text) // 4
+        if len(found) == limit or not max_edits:
+            return found
+        # Count the n-grams each product shares with text, leaving out
+        # those too common to help much.
+        grams = _all_grams(text)
+        common = max(64, len(self.products) // 8)
+        shared = collections.Counter()
+        for g in grams:
+            l = self.postings.get(g, ())
+            if len(l) <= common:
+                shared.update(l)
+        contained = {r[0][-1] for r in found}
+        fuzzy = []
+        for n, count in shared.most_common(limit * 2 + len(contained)):
+            if count * 3 < len(grams):
+                break
+            if n in contained:
+                continue
+            edits = min(_substring_distance(text, self.names[n]),
+                        _substring_distance(text, self.codes[n]))
+            if edits <= max_edits:
+                fuzzy.append(((True, 1, edits, -count,
+                               self.products[n].swap, n), self.products[n]))
+        fuzzy.sort(key=lambda r: r[0])
+        return found + fuzzy[:limit - len(found)]
+
+
+class _ProductIndex(MemoryIndex):
+    version_key = 'invoicer-product-index-version'
+    max_age_setting = 'PRODUCT_INDEX_MAX_AGE'
+
+    def _load(self):
+        types = {}
+        for p in Product.objects.all():
+            types.setdefault(p.type_id, _TypeIndex()).add(p)
+        units = {}
+        for u in Unit.objects.order_by('pk'):
+            for i in range(len(u.name) + 1):
+                units.setdefault(u.name[:i], []).append(u)
+        return types, units
+
+    def units(self, prefix):
+        """Units whose names start with prefix"""
+        return self._current()[1].get(prefix, [])
+
+    def search(self, unitname, text, exactmatch=False):
+        """(unit, product) pairs for an item description
+
+        Units are matched on the start of their name, and products of
+        the unit's type on their exact name (if exactmatch) or on any
+        part of their name or code.
+        """
+        types, units = self._current()
+        l = []
+        for unit in units.get(unitname, []):
+            ti = types.get(unit.type_id)
+            if not ti:
+                continue
+            if exactmatch:
+                p = ti.by_name.get(text)
+                products = [p] if p else []
+            else:
+                products = ti.containing(text)
+            l.extend((unit, p) for p in products)
+        return l
+
+    def ranked(self, unitname, text, limit):
+        """As search, for up to limit completions ranked best first
+
+        Products may also match text approximately; see
+        _TypeIndex.ranked.
+        """
+        types, units = self._current()
+        by_type = {}
+        l = []
+        for i, unit in enumerate(units.get(unitname, [])):
+            if unit.type_id not in by_type:
+                ti = types.get(unit.type_id)
+                by_type[unit.type_id] = ti.ranked(text, limit) if ti else []
+            l.extend((rank, i, unit, p) for rank, p in by_type[unit.type_id])
+        return [(unit, p) for rank, i, unit, p in heapq.nsmallest(
+            limit, l, key=lambda r: r[:2])]
+
+    def similar(self, text, limit):
+        """Up to limit products of any type like text, best first"""
+        types, units = self._current()
+        l = [r for ti in types.values() for r in ti.ranked(text, limit)]
+        return [p for rank, p in heapq.nsmallest(
+            limit, l, key=lambda r: r[0])]
+
+product_index = _ProductIndex()
+
+
+class _ProductQueries:
+    """The lookups of _ProductIndex, made in the database
+
+    Approximate matches are those pg_trgm finds similar, rather than
+    those within a few edits.
+    """
+    def units(self, prefix):
+        return [u for u in Unit.objects.order_by('pk')
+                if u.name.startswith(prefix)]
+
+    def _pairs(self, units, products):
+        by_type = {}
+        for p in products:
+            by_type.setdefault(p.type_id, []).append(p)
+        return [(unit, p) for unit in units
+                for p in by_type.get(unit.type_id, [])]
+
+    def search(self, unitname, text, exactmatch=False):
+        units = self.units(unitname)
+        products = Product.objects.filter(type__in={u.type_id for u in units})
+        if exactmatch:
+            products = products.filter(name=text)
+        else:
+            products = products.filter(
+                Q(name__icontains=text) | Q(code__icontains=text))
+        return self._pairs(units, products)
+
+    def _similar(self, products, text, limit):
+        # Imported here as it needs psycopg2
+        from django.contrib.postgres.search import TrigramSimilarity
+        return list(products.annotate(
+            uname=Upper('name'), ucode=Upper('code'),
+            similarity=Greatest(TrigramSimilarity('name', text),
+                                TrigramSimilarity('code', text)))
+                    .filter(Q(name__icontains=text) | Q(code__icontains=text)
+                            | Q(uname__trigram_similar=text.upper())
+                            | Q(ucode__trigram_similar=text.upper()))
+                    .order_by('-similarity', 'swap', 'name')[:limit])
+
+    def ranked(self, unitname, text, limit):
+        units = self.units(unitname)
+        if not units:
+            return []
+        products = self._similar(
+            Product.objects.filter(type__in={u.type_id for u in units}),
+            text, limit)
+        rank = {p.pk: i for i, p in enumerate(products)}
+        return sorted(self._pairs(units, products),
+                      key=lambda r: rank[r[1].pk])[:limit]
+
+    def similar(self, text, limit):
+        if not text.strip():
+            # As the index: nothing is like nothing
+            return []
+        return self._similar(Product.objects.all(), text, limit)
+
+_product_queries = _ProductQueries()
+
+def product_search():
+    """The product index or database lookups, as configured"""
+    if getattr(settings, 'PRODUCT_SEARCH', 'memory') == 'database':
+        return _product_queries
+    return product_index
+
+
+def _products_changed(sender, **kwargs):
+    if not changes_indexes(kwargs.get('update_fields')):
+        return
+    product_index.invalidate()
+    transaction.on_commit(lambda: product_index.invalidate(local_only=True))
+
+for _model in (Product, Unit, ProductType):
+    post_save.connect(_products_changed, sender=_model)
+    post_delete.connect(_products_changed, sender=_model)
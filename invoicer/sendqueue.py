@@ -0,0 +1,259 @@
+"""Sending invoices to Xero in the background
+
+"Send to Xero and start another" queues the invoice as a SendJob,
+already priced, rather than waiting for Xero.  Jobs queued in a process
+running the site are started straight away in the background, and
+jobs waiting together are sent together, in one request to Xero.
+
+Jobs that couldn't be sent are tried again later, and jobs left
+"sending" by a process that died are taken over after
+settings.SEND_JOB_TIMEOUT seconds, by whichever process next looks for
+work: a web process does so only when another job is queued, so the
+sendinvoices command must be kept running (or run with --once from
+cron) for them to happen on time.
+
+Each draft invoice has a key from new_draft, so that sending the same
+draft twice (by submitting the form again, say) doesn't make two
+invoices, but identical invoices drafted separately are both sent.
+"""
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Exists, OuterRef, Q
+from django.utils import timezone
+from invoicer import background, xero
+from invoicer.models import Product, SendJob, SentInvoice
+import datetime
+import logging
+import random
+import secrets
+log = logging.getLogger(__name__)
+
+
+def _send_products(products):
+    if products:
+        problem = xero.update_products(None, products)
+        if problem:
+            raise xero.Problem(
+                "Received {} response when sending product details to "
+                "Xero.  Products were: {}.".format(
+                    problem, [p.name for p in products]))
+        for p in products:
+            p.sent = True
+            p.save(update_fields=['sent'])
+
+
+# Stands in for Xero's warnings about an invoice that wasn't sent again
+ALREADY_SENT = "Xero already had this invoice, so it wasn't sent again"
+
+
+def new_draft():
+    """A key for a new draft invoice"""
+    return secrets.token_hex(8)
+
+
+def _sent(keys):
+    """Invoice IDs of the invoices with keys that Xero has accepted"""
+    return dict(SentInvoice.objects.filter(key__in=keys)
+                .values_list('key', 'invoice_id'))
+
+
+def send(contactid, products, lines, bill, date, duedate, reference,
+         draft="", force=False):
+    """Send an invoice to Xero, and first any products it needs
+
+    If this draft has been sent already, it isn't sent again unless
+    force is set.  Return the invoice ID and a list of warnings from
+    Xero, including ALREADY_SENT if it wasn't sent.  Raises xero.Problem.
+    """
+    if force:
+        # Neither we nor Xero should take it for the one already sent
+        draft = new_draft()
+    invoice = {'contactid': contactid, 'lines': lines, 'bill': bill,
+               'date': date, 'duedate': duedate, 'reference': reference}
+    key = xero.invoice_key(draft=draft, **invoice)
+    sent = _sent([key])
+    if sent:
+        return sent[key], [ALREADY_SENT]
+    _send_products(products)
+    invid, warnings = xero.send_invoice(None, draft=draft, **invoice)
+    SentInvoice.objects.get_or_create(key=key,
+                                      defaults={'invoice_id': invid})
+    return invid, warnings
+
+
+def _job_invoice(job):
+    """send_invoice's arguments for job"""
+    return {'contactid': job.contact_id, 'lines': job.lines, 'bill': job.bill,
+            'date': job.date, 'duedate': job.duedate,
+            'reference': job.reference}
+
+
+def enqueue(user, contactid, contactname, products, lines, bill, date,
+            duedate, reference, draft=""):
+    """Queue an invoice to be sent to Xero; return the SendJob"""
+    with transaction.atomic():
+        job = SendJob(
+            contact_id=contactid, contact_name=contactname, bill=bill,
+            date=date, duedate=duedate, reference=reference or "",
+            lines=lines, draft=draft, user=user)
+        job.key = xero.invoice_key(draft=draft, **_job_invoice(job))
+        job.save()
+        job.products.set(products)
+    background.run_again('send-jobs', run_pending)
+    return job
+
+
+def send_again(jobs):
+    """Queue jobs to be sent as new invoices, even if they were sent"""
+    for job in jobs:
+        if job.status == SendJob.SENDING:
+            continue
+        job.draft = new_draft()
+        job.key = xero.invoice_key(draft=job.draft, **_job_invoice(job))
+        job.status = SendJob.QUEUED
+        job.attempts = 0
+        job.next_try = timezone.now()
+        job.invoice_id = ""
+        job.request_key = ""
+        job.warnings = []
+        job.error = ""
+        job.save()
+    background.run_again('send-jobs', run_pending)
+
+
+def _claim(limit):
+    """Up to limit jobs due to be sent, marked as being sent
+
+    Jobs that were sent together before go together again, so that Xero
+    can tell it's the same request.  That includes jobs that have been
+    "sending" for so long that whatever was sending them must have died.
+
+    A job queued from the same draft as an earlier one waits until that
+    one is sent or has failed: until then, Xero may have had the
+    earlier one in a request with a different idempotency key.
+    """
+    now = timezone.now()
+    stale = now - datetime.timedelta(
+        seconds=getattr(settings, 'SEND_JOB_TIMEOUT', 900))
+    earlier = SendJob.objects.exclude(key="").filter(
+        key=OuterRef('key'), pk__lt=OuterRef('pk'),
+        status__in=(SendJob.QUEUED, SendJob.SENDING))
+    with transaction.atomic():
+        due = SendJob.objects.select_for_update(skip_locked=True)\
+                             .filter(Q(status=SendJob.QUEUED,
+                                       next_try__lte=now) |
+                                     Q(status=SendJob.SENDING,
+                                       updated__lt=stale))\
+                             .filter(~Exists(earlier))\
+                             .order_by('created')
+        first = due.first()
+        if first is None:
+            return []
+        jobs = list(due.filter(request_key=first.request_key)[:limit])
+        for job in jobs:
+            job.status = SendJob.SENDING
+            job.attempts += 1
+            job.save(update_fields=['status', 'attempts', 'updated'])
+        return jobs
+
+
+def _failed(job, e, next_try):
+    """Record that sending job failed with e, to try again if worthwhile"""
+    job.error = xero.message(e)
+    if isinstance(e, xero.Rejected) or job.attempts >= getattr(
+            settings, 'SEND_JOB_ATTEMPTS', 5):
+        job.status = SendJob.FAILED
+    else:
+        job.status = SendJob.QUEUED
+        job.next_try = next_try
+
+
+def run(jobs):
+    """Send claimed jobs to Xero in one request; record how each went"""
+    invoices = [_job_invoice(job) for job in jobs]
+    keys = [xero.invoice_key(draft=job.draft, **i)
+            for job, i in zip(jobs, invoices)]
+    sent = _sent(keys)
+    for job, key in zip(jobs, keys):
+        if key in sent:
+            job.invoice_id = sent[key]
+            job.warnings = [ALREADY_SENT]
+            job.status = SendJob.SENT
+            job.error = ""
+            job.save()
+    todo = []
+    for job, invoice, key in zip(jobs, invoices, keys):
+        if key in sent:
+            continue
+        if key in {t[2] for t in todo}:
+            # The same draft queued twice: it's found to have been sent
+            # once this request is recorded
+            job.status = SendJob.QUEUED
+            job.attempts -= 1
+            job.save(update_fields=['status', 'attempts', 'updated'])
+            continue
+        todo.append((job, invoice, key))
+    if not todo:
+        return
+    jobs, invoices, keys = map(list, zip(*todo))
+    request_key = xero.batch_key(keys)
+    for job in jobs:
+        if job.request_key != request_key:
+            job.request_key = request_key
+            job.save(update_fields=['request_key'])
+
+    try:
+        _send_products(list(Product.objects.filter(
+            sendjob__in=jobs, sent=False).distinct()))
+        results = xero.send_invoices(None, invoices, keys)
+    except xero.Rejected as e:
+        if len(jobs) > 1:
+            # Find out which of them Xero objects to
+            for job in jobs:
+                run([job])
+            return
+        results = [e]
+    except xero.ERRORS as e:
+        results = [e] * len(jobs)
+    except Exception as e:
+        log.exception("Sending %s failed", ", ".join(map(str, jobs)))
+        results = [xero.Rejected(str(e))] * len(jobs)
+    SentInvoice.objects.bulk_create(
+        [SentInvoice(key=key, invoice_id=result[0])
+         for key, result in zip(keys, results)
+         if not isinstance(result, Exception) and result[0]],
+        ignore_conflicts=True)
+    # Jobs sent together are tried again together, and they've all been
+    # tried as often.  Back off, but not in step with anything else that
+    # failed.
+    next_try = timezone.now() + datetime.timedelta(
+        seconds=random.uniform(0.5, 1) * min(
+            3600, 60 * 2 ** (jobs[0].attempts - 1)))
+    for job, result in zip(jobs, results):
+        if isinstance(result, Exception):
+            _failed(job, result, next_try)
+        else:
+            invoice_id, job.warnings, error = result
+            job.invoice_id = invoice_id or ""
+            if error:
+                _failed(job, xero.Rejected(error), next_try)
+            else:
+                job.status = SendJob.SENT
+                job.error = ""
+        job.save()
+        log.info("%s: %s %s", job, job.status, job.error)
+
+
+def run_pending():
+    """Send every job that is due; return how many were tried
+
+    Jobs that have built up while others were being sent go together,
+    up to settings.XERO_INVOICE_BATCH in a request.
+    """
+    n = 0
+    while True:
+        jobs = _claim(getattr(settings, 'XERO_INVOICE_BATCH', 50))
+        if not jobs:
+            return n
+        run(jobs)
+        n += len(jobs)
@@ -22,17 +22,67 @@ var addAutoComplete = function(basename){
 		      function(data) { response(data); });
 	},
 	onSelect: function(event, term, item){
-            $.getJSON(params['item_details_url'],
-		      { q: term,
-			band: params['priceband'],
-			contact: params['contact'],
-			bill: params['bill'] },
-		      function(data) {
-			  updateDesc(basename, data);
-			  updateTotals();
-		      });
+            updateLines();
 	},
     });
+    $('input[name="'+basename+'"]').on("change", updateLines);
+};
+
+/* Details of the lines in every band, and the lines they are for */
+var bandDetails = null;
+
+var showDetails = function(inputs, data) {
+    inputs.each(function(i, input) {
+	var line = $.extend({}, data['lines'][i]);
+	if (line['error'] == "" &&
+	    (input.value != input.defaultValue ||
+	     params['priceband'] != params['saved_priceband'])) {
+	    line['error'] = "(Not saved)";
+	};
+	updateDesc(input.name, line);
+    });
+    document.getElementById("total-ex-vat").innerHTML = data['total'];
+    document.getElementById("total-inc-vat").innerHTML = data['incvat'];
+};
+
+/* Fetch the details of every line, and the totals, in one request;
+   with allBands, for every price band at once */
+var updateLines = function(allBands) {
+    var inputs = $("td.invoiceitem input");
+    var q = inputs.map(function() { return this.value; }).get();
+    $.ajax({
+	type: "POST",
+	url: params['invoice_details_url'],
+	traditional: true,
+	data: { q: q,
+		band: params['priceband'],
+		contact: params['contact'],
+		bill: params['bill'],
+		all_bands: allBands === true ? "True" : "False",
+		csrfmiddlewaretoken: $("input[name=csrfmiddlewaretoken]").val() },
+	success: function(data) {
+	    if (data['error']) {
+		return;
+	    };
+	    if (data['bands']) {
+		bandDetails = { q: q.join("\n"), bands: data['bands'] };
+	    };
+	    showDetails(inputs, data);
+	},
+    });
+};
+
+/* Show prices in another band without a round trip if we can; the
+   band is saved with the rest of the form */
+var changeBand = function(band) {
+    params['priceband'] = band;
+    var inputs = $("td.invoiceitem input");
+    var q = inputs.map(function() { return this.value; }).get().join("\n");
+    if (bandDetails && bandDetails.q == q && bandDetails.bands[band]) {
+	showDetails(inputs, bandDetails.bands[band]);
+    } else {
+	updateLines(true);
+    };
 };
 
 var updateTotals = function() {
@@ -55,3 +105,42 @@ var updateTotals = function() {
     });
     document.getElementById("total-inc-vat").innerHTML = total.toFixed(2);
 };
+
+var addOrderPreview = function(textareaid, tableid) {
+    var timer = null;
+    var preview = function() {
+	$.post(params['order_lines_url'],
+	       { text: document.getElementById(textareaid).value,
+		 band: params['priceband'],
+		 contact: params['contact'],
+		 bill: params['bill'],
+		 csrfmiddlewaretoken: $("input[name=csrfmiddlewaretoken]").val() },
+	       function(data) {
+		   var table = $("#" + tableid);
+		   table.empty();
+		   if (data['error']) {
+		       table.append($("<tr>").append(
+			   $("<td>").addClass("error").text(data['error'])));
+		       return;
+		   };
+		   $.each(data['lines'], function(i, line) {
+		       var item = line['item'];
+		       if (item == "" && line['candidates'].length > 0) {
+			   item = "Did you mean: " + line['candidates'].join(", ");
+		       };
+		       table.append($("<tr>").append(
+			   $("<td>").text(line['line']),
+			   $("<td>").text(item),
+			   $("<td>").text(line['barrels'] || ""),
+			   $("<td>").addClass("price").text(line['total'] || ""),
+			   $("<td>").addClass("price").text(line['incvat'] || ""),
+			   $("<td>").text(line['account'] || ""),
+			   $("<td>").addClass("error").text(line['error'])));
+		   });
+	       });
+    };
+    $("#" + textareaid).on("input", function() {
+	clearTimeout(timer);
+	timer = setTimeout(preview, 500);
+    });
+};
@@ -0,0 +1,224 @@
+"""Synthetic catalogs for load testing and benchmarks
+
+The rules follow the shape of the real price list (see migration
+0012_data): a table of prices by ABV for each band and product type,
+accounts for invoices and bills, swap premiums, rounding rules for
+small units, and price overrides for particular products and contacts.
+
+Everything is created with bulk_create, a batch at a time so that
+large catalogs needn't fit in memory.  That doesn't send signals;
+build_catalog invalidates the in-memory rule and product indexes when
+it's done, but the PriceMatrix (if enabled) must be rebuilt separately.
+measure times the code under test, for the benchpricing command and
+the benchmarks in tests.py.
+"""
+from decimal import Decimal
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from invoicer.models import *
+from invoicer.search import product_index
+import random
+import statistics
+import time
+import tracemalloc
+
+UNITS = {
+    "Cask Ale": [("firkin", "0.25"), ("pin", "0.125"),
+                 ("kilderkin", "0.5"), ("polypin", "0.1")],
+    "Craft Keg": [("30l keg", "0.1833"), ("50l keg", "0.3055")],
+}
+
+PROGRAM_RULES = [
+    ("Round up to £1 inc VAT", "vat-roundup-pound"),
+    ("Round up to 50p inc VAT", "vat-roundup-50p"),
+    ("Round up to £1 per barrel", "barrel-roundup-pound"),
+    ("Round item up to £1", "item-roundup-pound"),
+    ("Multiply by 1.1", "multiply-by-1.1"),
+]
+
+ABVS = [Decimal(x).scaleb(-1) for x in range(30, 76)]
+
+_words = ["Amber", "Black", "Bright", "Copper", "Dark", "Golden", "Hoppy",
+          "Midnight", "Old", "Pale", "Red", "Ruby", "Smoked", "Summer",
+          "Winter", "Wild"]
+_nouns = ["Ale", "Bitter", "Gold", "IPA", "Mild", "Porter", "Session",
+          "Stout", "Lager", "Saison"]
+
+
+class _Batch:
+    """Collects objects and creates them a batch at a time"""
+    def __init__(self, model, batch_size):
+        self.model = model
+        self.batch_size = batch_size
+        self.pending = []
+        self.count = 0
+
+    def append(self, obj):
+        self.pending.append(obj)
+        self.count += 1
+        if len(self.pending) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        self.model.objects.bulk_create(self.pending)
+        self.pending = []
+
+
+def _create(objs, key, batch_size):
+    """bulk_create objs, and return them with their primary keys
+
+    Only some databases set the primary keys in bulk_create, so fetch
+    the objects again by a unique field.
+    """
+    model = type(objs[0]) if objs else None
+    created = []
+    for i in range(0, len(objs), batch_size):
+        batch = objs[i:i + batch_size]
+        model.objects.bulk_create(batch)
+        found = {getattr(o, key): o for o in model.objects.filter(
+            **{f"{key}__in": [getattr(o, key) for o in batch]})}
+        created.extend(found[getattr(o, key)] for o in batch)
+    return created
+
+def build_catalog(bands=50, products=5000, rules=50000, contacts=2000,
+                  seed=0, prefix="Synthetic", batch_size=5000):
+    """Fill the pricing tables with a reproducible synthetic catalog
+
+    prefix is used in names and codes, so that catalogs with different
+    prefixes can coexist.  rules is approximate: the ABV tables and
+    fixed rules are always created, and overrides for products and
+    contacts make up the rest.  Return a dict of what was created.
+    """
+    rnd = random.Random(seed)
+    now = timezone.now()
+
+    types = {}
+    units = {}
+    for tname, tunits in UNITS.items():
+        types[tname], _ = ProductType.objects.get_or_create(name=tname)
+        units[tname] = []
+        for uname, size in tunits:
+            u = Unit.objects.filter(name=uname, type=types[tname]).first()
+            if not u:
+                u = Unit.objects.create(name=uname, size=Decimal(size),
+                                        type=types[tname])
+            units[tname].append(u)
+    cask = types["Cask Ale"]
+    keg = types["Craft Keg"]
+    type_units = {types[t].pk: units[t] for t in types}
+    programrules = {}
+    for name, code in PROGRAM_RULES:
+        programrules[code] = ProgramRule.objects.filter(code=code).first() \
+            or ProgramRule.objects.create(name=name, code=code)
+
+    band_list = _create(
+        [PriceBand(name=f"{prefix} band {i}") for i in range(bands)],
+        'name', batch_size)
+
+    product_list = []
+    for i in range(products):
+        ptype = cask if rnd.random() < 0.75 else keg
+        product_list.append(Product(
+            code=f"{prefix[:20]}-{i}",
+            name=f"{prefix} {rnd.choice(_words)} {rnd.choice(_nouns)} {i}",
+            abv=rnd.choice(ABVS), type=ptype, swap=rnd.random() < 0.3))
+    product_list = _create(product_list, 'code', batch_size)
+
+    contact_list = _create(
+        [Contact(xero_id="{:08x}-0000-4000-8000-{:012x}".format(
+            rnd.getrandbits(32), i),
+                 priceband=rnd.choice(band_list),
+                 name=f"{prefix} contact {i}", updated=now)
+         for i in range(contacts)], 'xero_id', batch_size)
+
+    prices = _Batch(Price, batch_size)
+    # Accounts, as in 0012_data
+    prices.append(Price(type=cask, isSwap=False, isBill=False,
+                        account="40000", priority=10))
+    prices.append(Price(type=cask, isSwap=True, isBill=False,
+                        account="41000", priority=10))
+    prices.append(Price(type=keg, isBill=False, account="40100",
+                        priority=10))
+    prices.append(Price(isBill=True, account="50100", priority=15))
+    for b in band_list[:3]:
+        prices.append(Price(type=cask, band=b, isBill=False,
+                            account="42000", priority=15))
+    # ABV tables: price per barrel by band, type and ABV
+    for b in band_list:
+        base = rnd.randint(250, 400)
+        for t in (cask, keg):
+            for abv in ABVS:
+                prices.append(Price(
+                    band=b, type=t, abv=abv, priority=20,
+                    price=Decimal(base + int(abv * 20)
+                                  + (60 if t == keg else 0))))
+    # Swap premium
+    for b in band_list:
+        if rnd.random() < 0.5:
+            prices.append(Price(band=b, type=cask, isSwap=True,
+                                price=Decimal(10), priority=30))
+    # Rounding for small units
+    prices.append(Price(unit=units["Cask Ale"][1],
+                        rule=programrules["vat-roundup-50p"], priority=50))
+    prices.append(Price(unit=units["Cask Ale"][3],
+                        rule=programrules["vat-roundup-pound"], priority=50))
+    # A few overrides for one contact in ten
+    for c in rnd.sample(contact_list, len(contact_list) // 10):
+        for i in range(rnd.randint(1, 3)):
+            prices.append(Price(
+                contact=c, type=rnd.choice((cask, keg, None)),
+                price=Decimal(-rnd.randint(0, 3000)).scaleb(-2),
+                priority=25))
+    # Overrides for particular products make up the rest
+    for i in range(max(rules - prices.count, 0)):
+        p = rnd.choice(product_list)
+        prices.append(Price(
+            band=rnd.choice(band_list) if rnd.random() < 0.8 else None,
+            product=p, unit=rnd.choice(type_units[p.type_id])
+            if rnd.random() < 0.5 else None,
+            price=Decimal(rnd.randint(-2000, 2000)).scaleb(-2),
+            priority=40))
+    prices.flush()
+    price_rules.invalidate()
+    product_index.invalidate()
+
+    return {
+        'bands': band_list,
+        'products': product_list,
+        'contacts': contact_list,
+        'units': [u for ul in units.values() for u in ul],
+        'rules': prices.count,
+    }
+
+
+def measure(fn, args):
+    """Call fn on each of args; return timings, queries and memory
+
+    Times are in microseconds.  Memory is traced in a second pass, as
+    tracing slows the calls down: memory_kb is what the calls left
+    allocated, and peak_memory_kb the most allocated at once.
+    """
+    times = []
+    with CaptureQueriesContext(connection) as queries:
+        for a in args:
+            start = time.perf_counter()
+            fn(a)
+            times.append((time.perf_counter() - start) * 1e6)
+    tracemalloc.start()
+    try:
+        for a in args:
+            fn(a)
+        size, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    times.sort()
+    return {
+        'calls': len(times),
+        'mean_us': round(statistics.mean(times), 1),
+        'p50_us': round(times[len(times) // 2], 1),
+        'p95_us': round(times[int(len(times) * 0.95)], 1),
+        'queries_per_call': round(len(queries) / len(times), 2),
+        'memory_kb': size // 1024,
+        'peak_memory_kb': peak // 1024,
+    }
@@ -1,3 +1,690 @@
-from django.test import TestCase
+from decimal import Decimal
+from django.contrib.auth.models import User
+from django.db import connection
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from invoicer import (contacts, programrules, sendqueue, synthetic, views,
+                      xero)
+from invoicer.models import (Contact, IndexVersion, Price, PriceBand,
+                             Product, ProductType, ProgramRule, SendJob,
+                             SentInvoice, Unit,
+                             XeroContact, XeroSync, matrix_prices,
+                             price_many, price_rules, update_price_matrix,
+                             _apply_rules_in_pence)
+from invoicer.search import _product_queries, product_index
+from unittest import mock
+from urllib.parse import parse_qs, urlparse
+import datetime
+import json
+import os
+import random
+import requests
+import threading
+import time
 
-# Create your tests here.
+
+class _XeroContacts(BaseHTTPRequestHandler):
+    """Answers GET /Contacts/ as Xero does, from self.server.contacts"""
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        params = {k: v[0] for k, v in parse_qs(url.query).items()}
+        self.server.requests.append(
+            (url.path, params, self.headers.get('If-Modified-Since')))
+        if self.server.unreadable:
+            # A proxy's error page, say
+            body = b"<html><body>Down for maintenance<br></body>"
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/html')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+            return
+        since = self.headers.get('If-Modified-Since')
+        if since:
+            since = datetime.datetime.strptime(
+                since, "%Y-%m-%dT%H:%M:%S").replace(
+                    tzinfo=datetime.timezone.utc)
+        found = sorted(
+            (c for c in self.server.contacts
+             if (not since or c['updated'] > since)
+             and (c['status'] != 'ARCHIVED'
+                  or params.get('includeArchived') == 'true')),
+            key=lambda c: c['updated'])
+        page = int(params.get('page', 1))
+        body = json.dumps({"Contacts": [{
+            "ContactID": c['id'],
+            "Name": c['name'],
+            "FirstName": "",
+            "LastName": "",
+            "ContactStatus": c['status'],
+            "UpdatedDateUTC": "/Date({}+0000)/".format(
+                int(c['updated'].timestamp() * 1000)),
+        } for c in found[(page - 1) * 100:page * 100]]}).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class ContactSyncTests(TestCase):
+    """contacts.sync against a stand-in for the Xero API"""
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.server = ThreadingHTTPServer(('127.0.0.1', 0), _XeroContacts)
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+        cls.patches = [
+            mock.patch.object(xero, 'XERO_ENDPOINT_URL', 'http://{}:{}/'.format(
+                *cls.server.server_address)),
+            # oauthlib won't send a token over plain HTTP otherwise
+            mock.patch.dict(os.environ, {'OAUTHLIB_INSECURE_TRANSPORT': '1'}),
+        ]
+        for p in cls.patches:
+            p.start()
+
+    @classmethod
+    def tearDownClass(cls):
+        for p in cls.patches:
+            p.stop()
+        cls.server.shutdown()
+        cls.server.server_close()
+        super().tearDownClass()
+
+    def setUp(self):
+        xero.save_token({'access_token': 'a', 'refresh_token': 'r',
+                         'token_type': 'Bearer',
+                         'expires_at': time.time() + 3600})
+        self.start = datetime.datetime(2024, 1, 1, tzinfo=datetime.timezone.utc)
+        self.server.contacts = [
+            {'id': 'c{}'.format(i), 'name': 'Pub {}'.format(i),
+             'status': 'ACTIVE',
+             'updated': self.start + datetime.timedelta(minutes=i)}
+            for i in range(150)]
+        self.server.requests = []
+        self.server.unreadable = False
+
+    def change(self, i, **kwargs):
+        c = self.server.contacts[i]
+        c.update(kwargs)
+        c['updated'] = max(x['updated'] for x in self.server.contacts) \
+            + datetime.timedelta(minutes=1)
+
+    def test_first_sync_copies_everything(self):
+        self.assertEqual(contacts.sync(None), 150)
+        self.assertEqual(XeroContact.objects.count(), 150)
+        self.assertEqual([(r[1]['page'], r[2]) for r in self.server.requests],
+                         [('1', None), ('2', None)])
+        self.assertEqual(XeroSync.objects.get(name='contacts').high_water,
+                         self.start + datetime.timedelta(minutes=149))
+
+    def test_later_syncs_fetch_only_changes(self):
+        contacts.sync(None)
+        self.server.requests = []
+        self.change(3, name='The Renamed Arms')
+        self.assertEqual(contacts.sync(None), 1)
+        self.assertEqual(self.server.requests[0][2], "2024-01-01T02:29:00")
+        self.assertEqual(XeroContact.objects.get(contact_id='c3').name,
+                         'The Renamed Arms')
+        self.server.requests = []
+        self.assertEqual(contacts.sync(None), 0)
+        self.assertEqual(len(self.server.requests), 1)
+
+    def test_archived_contacts_are_synced_but_not_offered(self):
+        contacts.sync(None)
+        self.change(5, status='ARCHIVED')
+        self.assertEqual(contacts.sync(None), 1)
+        self.assertEqual(self.server.requests[-1][1]['includeArchived'],
+                         'true')
+        self.assertEqual(XeroContact.objects.get(contact_id='c5').status,
+                         'ARCHIVED')
+        self.assertEqual([c.contact_id for c in contacts.search('Pub 5')],
+                         ['c50', 'c51', 'c52', 'c53', 'c54', 'c55', 'c56',
+                          'c57', 'c58', 'c59'])
+
+    def test_sync_already_under_way_does_nothing(self):
+        # sqlite has no row locks, so stand in for another sync's
+        locked = mock.Mock()
+        locked.filter.return_value.first.return_value = None
+        with mock.patch.object(XeroSync.objects, 'select_for_update',
+                               return_value=locked):
+            self.assertEqual(contacts.sync(None), 0)
+        locked.filter.assert_called_with(name='contacts')
+        self.assertEqual(self.server.requests, [])
+        self.assertEqual(XeroContact.objects.count(), 0)
+
+    def test_unreadable_response_is_a_problem(self):
+        contacts.sync(None)
+        self.server.unreadable = True
+        self.change(3, name='The Renamed Arms')
+        for format in ('json', 'xml'):
+            with self.settings(XERO_FORMAT=format):
+                with self.assertRaises(xero.Problem):
+                    contacts.sync(None)
+                with self.assertRaises(xero.Problem):
+                    xero.get_contact(None, 'c3')
+        self.assertEqual(XeroSync.objects.get(name='contacts').high_water,
+                         self.start + datetime.timedelta(minutes=149))
+
+    def test_contacts_we_keep_details_for_are_renamed(self):
+        contacts.sync(None)
+        c = Contact.objects.create(
+            xero_id='c7', name='Pub 7', updated=self.start,
+            priceband=PriceBand.objects.create(name='Trade'))
+        self.change(7, name='The Seven Stars')
+        contacts.sync(None)
+        c.refresh_from_db()
+        self.assertEqual(c.name, 'The Seven Stars')
+
+
+class PricingBenchmarks(TestCase):
+    """Timings, queries and memory for each pricing path
+
+    Each test measures one path over a small synthetic catalog with
+    synthetic.measure, and checks it makes no more queries than it
+    should.  Set BENCHMARK_OUTPUT to a filename to keep the results as
+    JSON; manage.py benchpricing does the same at full scale.
+    """
+    results = {}
+
+    @classmethod
+    def setUpTestData(cls):
+        synthetic.build_catalog(bands=5, products=200, rules=2000,
+                                contacts=50, prefix="Bench")
+
+    @classmethod
+    def tearDownClass(cls):
+        super().tearDownClass()
+        # Don't leave the rolled back catalog in memory
+        price_rules.invalidate(local_only=True)
+        product_index.invalidate(local_only=True)
+        output = os.environ.get('BENCHMARK_OUTPUT')
+        if output:
+            with open(output, 'w') as f:
+                json.dump(cls.results, f, indent=2)
+
+    def setUp(self):
+        rnd = random.Random(0)
+        self.bands = list(PriceBand.objects.all())
+        products = list(Product.objects.select_related('type'))
+        units = {}
+        for u in Unit.objects.all():
+            units.setdefault(u.type_id, []).append(u)
+        contact_list = [None] + list(Contact.objects.all())
+
+        def item():
+            p = rnd.choice(products)
+            return views.InvoiceItem(
+                rnd.randint(1, 10), rnd.choice(units[p.type_id]), p,
+                rnd.random() < 0.1, rnd.choice(contact_list))
+        self.item = item
+        self.lines = [(item(), rnd.choice(self.bands)) for i in range(50)]
+        # Load the indexes, except where that's what is measured
+        price_rules.rules_for(self.bands[0], self.lines[0][0])
+        product_index.units("")
+
+    def benchmark(self, name, fn, args=None):
+        result = synthetic.measure(fn, self.lines if args is None else args)
+        self.results[name] = result
+        return result
+
+    def test_rule_index_load(self):
+        price_rules.invalidate(local_only=True)
+        with CaptureQueriesContext(connection) as queries:
+            price_rules.rules_for(self.bands[0], self.lines[0][0])
+        self.assertEqual(len(queries), 1)
+
+    def test_apply_rules_for(self):
+        r = self.benchmark('apply_rules_for',
+                           lambda l: l[1].apply_rules_for(l[0]))
+        self.assertEqual(r['queries_per_call'], 0)
+
+    def test_price_many_integer(self):
+        with override_settings(INTEGER_PRICING=True):
+            # The first use of each rule converts its amounts to pence
+            integer = [price_many([l[0]], [l[1]]) for l in self.lines]
+            r = self.benchmark('price_many_integer',
+                               lambda l: price_many([l[0]], [l[1]]))
+        self.assertEqual(r['queries_per_call'], 0)
+        self.assertEqual(
+            integer, [price_many([l[0]], [l[1]]) for l in self.lines])
+
+    def test_price_many_decimal(self):
+        r = self.benchmark('price_many_decimal',
+                           lambda l: price_many([l[0]], [l[1]]))
+        self.assertEqual(r['queries_per_call'], 0)
+
+    def test_price_many_all_bands(self):
+        r = self.benchmark('price_many_all_bands',
+                           lambda l: price_many([l[0]], self.bands))
+        self.assertEqual(r['queries_per_call'], 0)
+
+    def test_invoice(self):
+        def invoice(l):
+            items = [self.item() for i in range(20)]
+            views.price_items(items, [l[1]])
+        r = self.benchmark('invoice', invoice, self.lines[:20])
+        self.assertEqual(r['queries_per_call'], 0)
+
+    def test_parse_item_exact(self):
+        r = self.benchmark('parse_item_exact', lambda l: views.parse_item(
+            f"{l[0].items} {l[0].unit.name} {l[0].product.name}",
+            exactmatch=True))
+        self.assertEqual(r['queries_per_call'], 0)
+
+    def test_parse_item_completion(self):
+        r = self.benchmark('parse_item_completion', lambda l: views.parse_item(
+            f"{l[0].items} {l[0].unit.name} {l[0].product.name[:6]}"))
+        self.assertEqual(r['queries_per_call'], 0)
+
+    @override_settings(PRICE_MATRIX=True)
+    def test_matrix_lookup(self):
+        update_price_matrix()
+        r = self.benchmark('matrix_lookup',
+                           lambda l: matrix_prices([l[0]], [l[1]]))
+        self.assertLessEqual(r['queries_per_call'], 1)
+
+
+class SendQueueTests(TestCase):
+    """Queued invoices, with xero.send_invoices standing in for Xero"""
+
+    def setUp(self):
+        patch = mock.patch.object(sendqueue.background, 'run_again')
+        patch.start()
+        self.addCleanup(patch.stop)
+        self.sends = []
+        self.responses = []
+
+    def send_invoices(self, request, invoices, keys):
+        self.sends.append((len(invoices), xero.batch_key(keys)))
+        response = self.responses.pop(0)
+        if isinstance(response, Exception):
+            raise response
+        return response
+
+    def enqueue(self, draft, reference="Order 1"):
+        return sendqueue.enqueue(
+            None, 'c1', 'Pub 1', [], [{'Description': '1 firkin Ale',
+                                       'Quantity': '1',
+                                       'UnitAmount': '100.00'}],
+            False, datetime.date(2024, 1, 1), None, reference, draft)
+
+    def run_pending(self):
+        with mock.patch.object(xero, 'send_invoices', self.send_invoices):
+            return sendqueue.run_pending()
+
+    def test_jobs_waiting_together_are_sent_together(self):
+        jobs = [self.enqueue('d{}'.format(i)) for i in range(3)]
+        self.responses = [[('inv-{}'.format(i), [], None) for i in range(3)]]
+        self.assertEqual(self.run_pending(), 3)
+        self.assertEqual([n for n, key in self.sends], [3])
+        for i, job in enumerate(jobs):
+            job.refresh_from_db()
+            self.assertEqual((job.status, job.invoice_id),
+                             (SendJob.SENT, 'inv-{}'.format(i)))
+
+    def test_failed_request_is_tried_again_as_it_was(self):
+        jobs = [self.enqueue('d1'), self.enqueue('d2')]
+        self.responses = [requests.ConnectionError("down"),
+                          [('inv-1', [], None), ('inv-2', [], None)]]
+        self.run_pending()
+        SendJob.objects.update(next_try=jobs[0].created)
+        # Another job queued meanwhile waits for the retry to be sent
+        later = self.enqueue('d3')
+        self.responses.append([('inv-3', [], None)])
+        self.assertEqual(self.run_pending(), 3)
+        self.assertEqual(self.sends[0], self.sends[1])
+        self.assertEqual(self.sends[1][0], 2)
+        self.assertEqual(self.sends[2], (1, later.key))
+        self.assertEqual(
+            sorted(SendJob.objects.values_list('invoice_id', 'attempts')),
+            [('inv-1', 2), ('inv-2', 2), ('inv-3', 1)])
+
+    def test_rejected_request_is_split(self):
+        good = self.enqueue('d1')
+        bad = self.enqueue('d2', reference="Bad")
+        self.responses = [xero.Rejected("Account code is not valid"),
+                          [('inv-1', [], None)],
+                          xero.Rejected("Account code is not valid")]
+        self.assertEqual(self.run_pending(), 2)
+        self.assertEqual([n for n, key in self.sends], [2, 1, 1])
+        good.refresh_from_db()
+        bad.refresh_from_db()
+        self.assertEqual((good.status, good.invoice_id),
+                         (SendJob.SENT, 'inv-1'))
+        self.assertEqual((bad.status, bad.error),
+                         (SendJob.FAILED, "Account code is not valid"))
+
+    @override_settings(SEND_JOB_ATTEMPTS=2)
+    def test_gives_up_after_so_many_attempts(self):
+        job = self.enqueue('d1')
+        self.responses = [requests.Timeout("slow")] * 2
+        for i in range(2):
+            SendJob.objects.update(next_try=job.created)
+            self.assertEqual(self.run_pending(), 1)
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.attempts, job.error),
+                         (SendJob.FAILED, 2, "slow"))
+        self.assertEqual(self.run_pending(), 0)
+
+    def test_stale_sending_job_is_taken_over(self):
+        job = self.enqueue('d1')
+        SendJob.objects.update(status=SendJob.SENDING)
+        self.assertEqual(self.run_pending(), 0)
+        SendJob.objects.update(updated=job.created - datetime.timedelta(
+            hours=1))
+        self.responses = [[('inv-1', [], None)]]
+        self.assertEqual(self.run_pending(), 1)
+        self.assertEqual(self.sends, [(1, job.key)])
+
+    def test_sent_again_as_a_new_invoice(self):
+        job = self.enqueue('d1')
+        self.responses = [[('inv-1', [], None)], [('inv-2', [], None)]]
+        self.run_pending()
+        sendqueue.send_again(SendJob.objects.all())
+        self.run_pending()
+        job.refresh_from_db()
+        self.assertEqual(job.invoice_id, 'inv-2')
+        self.assertNotEqual(self.sends[0][1], self.sends[1][1])
+
+    def test_draft_is_only_sent_once(self):
+        invoice = ('c1', [], [{'Description': '1 firkin Ale'}], False,
+                   datetime.date(2024, 1, 1), None, "Order 1")
+        with mock.patch.object(xero, 'send_invoice',
+                               return_value=('inv-1', [])) as send:
+            self.assertEqual(sendqueue.send(*invoice, draft='d1'),
+                             ('inv-1', []))
+            self.assertEqual(sendqueue.send(*invoice, draft='d1'),
+                             ('inv-1', [sendqueue.ALREADY_SENT]))
+            # The same invoice drafted separately, and sent anyway
+            sendqueue.send(*invoice, draft='d2')
+            sendqueue.send(*invoice, draft='d1', force=True)
+        self.assertEqual(send.call_count, 3)
+        self.assertEqual(SentInvoice.objects.count(), 3)
+
+    def test_invoice_keys(self):
+        invoice = {'contactid': 'c1', 'lines': [{'Description': 'Ale'}],
+                   'bill': False, 'date': datetime.date(2024, 1, 1),
+                   'duedate': None, 'reference': "Order 1"}
+        key = xero.invoice_key(**invoice)
+        self.assertEqual(key, xero.invoice_key(**invoice))
+        self.assertEqual(key, xero.invoice_key(draft="", **invoice))
+        self.assertNotEqual(key, xero.invoice_key(draft="d1", **invoice))
+        self.assertNotEqual(key, xero.invoice_key(
+            **dict(invoice, reference="Order 2")))
+        self.assertEqual(xero.batch_key([key]), key)
+        self.assertNotEqual(xero.batch_key([key, key + "x"]),
+                            xero.batch_key([key + "x", key]))
+
+    def test_sending_products_keeps_indexes(self):
+        product = Product.objects.create(
+            code='ALE1', name='Ale', abv=4,
+            type=ProductType.objects.create(name='Cask Ale'))
+        versions = dict(IndexVersion.objects.values_list('name', 'version'))
+        with mock.patch.object(xero, 'update_products', return_value=None):
+            sendqueue._send_products([product])
+        product.refresh_from_db()
+        self.assertTrue(product.sent)
+        self.assertEqual(
+            dict(IndexVersion.objects.values_list('name', 'version')),
+            versions)
+        product.name = 'Best Ale'
+        product.save()
+        self.assertNotEqual(
+            dict(IndexVersion.objects.values_list('name', 'version')),
+            versions)
+
+    def test_draft_queued_twice_waits_for_the_first(self):
+        first = self.enqueue('d1')
+        second = self.enqueue('d1')
+        self.responses = [requests.Timeout("slow")]
+        self.assertEqual(self.run_pending(), 1)
+        first.refresh_from_db()
+        second.refresh_from_db()
+        self.assertEqual(first.status, SendJob.QUEUED)
+        self.assertEqual((second.status, second.attempts),
+                         (SendJob.QUEUED, 0))
+        # Neither is tried while the first is waiting to be tried again
+        self.assertEqual(self.run_pending(), 0)
+
+        SendJob.objects.filter(pk=first.pk).update(next_try=first.created)
+        self.responses = [[('inv-1', [], None)]]
+        self.assertEqual(self.run_pending(), 2)
+        first.refresh_from_db()
+        second.refresh_from_db()
+        self.assertEqual((first.status, first.invoice_id),
+                         (SendJob.SENT, 'inv-1'))
+        self.assertEqual((second.status, second.invoice_id, second.warnings),
+                         (SendJob.SENT, 'inv-1', [sendqueue.ALREADY_SENT]))
+        # Sent once, and again with the same key
+        self.assertEqual(self.sends, [(1, first.key)] * 2)
+
+
+@override_settings(PRICE_MATRIX=True)
+class PriceMatrixTests(TestCase):
+    """The PriceMatrix agrees with price_many as things are edited"""
+
+    @classmethod
+    def setUpTestData(cls):
+        synthetic.build_catalog(bands=3, products=30, rules=300,
+                                contacts=20, prefix="Matrix")
+
+    @classmethod
+    def tearDownClass(cls):
+        super().tearDownClass()
+        price_rules.invalidate(local_only=True)
+        product_index.invalidate(local_only=True)
+
+    def setUp(self):
+        update_price_matrix()
+        self.bands = list(PriceBand.objects.all())
+
+    def items(self):
+        units = {}
+        for u in Unit.objects.all():
+            units.setdefault(u.type_id, []).append(u)
+        contact_list = [None] + list(
+            Contact.objects.filter(price__isnull=False).distinct()[:5])
+        return [views.InvoiceItem(1, u, p, bill, c)
+                for p in Product.objects.all()
+                for u in units[p.type_id]
+                for bill in (False, True)
+                for c in contact_list]
+
+    def assertMatrixMatches(self):
+        items = self.items()
+        matrix = matrix_prices(items, self.bands)
+        rules = price_many(items, self.bands)
+        found = 0
+        for item, m, r in zip(items, matrix, rules):
+            for band, cell, priced in zip(self.bands, m, r):
+                if cell is not None:
+                    found += 1
+                    self.assertEqual(cell, priced, (str(item), band))
+        # Only cells for contacts outside their own band are missing
+        self.assertGreater(found, len(items) * len(self.bands) // 2)
+
+    def test_full_rebuild(self):
+        self.assertMatrixMatches()
+
+    def test_rule_edited(self):
+        rule = Price.objects.filter(band__isnull=False, abv__isnull=False)\
+                            .first()
+        with self.captureOnCommitCallbacks(execute=True):
+            rule.price += 25
+            rule.save()
+        self.assertMatrixMatches()
+
+    def test_product_edited(self):
+        product = Product.objects.first()
+        with self.captureOnCommitCallbacks(execute=True):
+            product.abv += 1
+            product.swap = not product.swap
+            product.save()
+        self.assertMatrixMatches()
+
+    def test_contact_moved_to_another_band(self):
+        contact = Contact.objects.filter(price__isnull=False).first()
+        with self.captureOnCommitCallbacks(execute=True):
+            contact.priceband = next(
+                b for b in self.bands if b.pk != contact.priceband_id)
+            contact.save()
+        self.assertMatrixMatches()
+
+
+class PricingTests(TestCase):
+    """Integer pence agrees with Decimal, including the rounding rules"""
+
+    @classmethod
+    def setUpTestData(cls):
+        synthetic.build_catalog(bands=3, products=60, rules=600,
+                                contacts=20, prefix="Pricing")
+
+    @classmethod
+    def tearDownClass(cls):
+        super().tearDownClass()
+        price_rules.invalidate(local_only=True)
+        product_index.invalidate(local_only=True)
+
+    def test_pence_matches_decimal(self):
+        bands = list(PriceBand.objects.all())
+        units = {}
+        for u in Unit.objects.all():
+            units.setdefault(u.type_id, []).append(u)
+        contact_list = [None] + list(Contact.objects.all()[:5])
+        items = [views.InvoiceItem(n, u, p, bill, c)
+                 for p in Product.objects.all()
+                 for u in units[p.type_id]
+                 for n in (1, 3)
+                 for bill in (False, True)
+                 for c in contact_list]
+        decimal = price_many(items, bands)
+        with override_settings(INTEGER_PRICING=True):
+            integer = price_many(items, bands)
+        self.assertEqual(integer, decimal)
+        # The rounding rules were worked out in pence, not passed over
+        rounding = ProgramRule.objects.filter(code__startswith="vat-roundup")
+        rounded = 0
+        for item in items:
+            for rules in price_rules.rules_for_bands(bands, item):
+                if any(r.rule_id in {p.pk for p in rounding}
+                       for r in rules):
+                    rounded += 1
+                    self.assertIsNotNone(
+                        _apply_rules_in_pence(rules, item))
+        self.assertGreater(rounded, 0)
+
+
+class ProgramRuleTests(TestCase):
+    """Looking up the Rules for ProgramRule codes"""
+
+    def setUp(self):
+        patch = mock.patch.object(programrules, '_prefixes',
+                                  list(programrules._prefixes))
+        patch.start()
+        self.addCleanup(patch.stop)
+
+    def test_longest_prefix_first(self):
+        @programrules.register("add-", prefix=True)
+        class Add(programrules.Rule):
+            pass
+
+        @programrules.register("add-per-barrel-", prefix=True)
+        class AddPerBarrel(programrules.Rule):
+            pass
+
+        for code, cls, param in (("add-per-barrel-5", AddPerBarrel, "5"),
+                                 ("add-5", Add, "5"),
+                                 ("add-per-5", Add, "per-5"),
+                                 ("multiply-by-1.1", None, "1.1"),
+                                 ("unknown", programrules.Rule, "")):
+            rule = programrules.resolve(code)
+            if cls:
+                self.assertIs(type(rule), cls)
+            self.assertEqual(rule.param, param)
+
+
+class ItemParsingTests(TestCase):
+    """parse_item, and the pages that price what it finds"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cask = ProductType.objects.create(name="Cask Ale")
+        Unit.objects.create(name="firkin", size=Decimal("0.25"), type=cask)
+        cls.band = PriceBand.objects.create(name="Trade")
+        Price.objects.create(type=cask, isBill=False, account="40000",
+                             priority=10)
+        Price.objects.create(band=cls.band, type=cask, price=Decimal(300),
+                             priority=20)
+        for code, name in (("MS", "Midnight Stout"),
+                           ("MP", "Midnight Porter"),
+                           ("GA", "Golden Ale")):
+            Product.objects.create(code=code, name=name, abv=Decimal("4.5"),
+                                   type=cask)
+        cls.user = User.objects.create_user('brewer')
+
+    @classmethod
+    def tearDownClass(cls):
+        super().tearDownClass()
+        price_rules.invalidate(local_only=True)
+        product_index.invalidate(local_only=True)
+
+    def test_exact_match(self):
+        l = views.parse_item("2 firkins Golden Ale", exactmatch=True)
+        self.assertEqual([(i.items, i.unit.name, i.product.code) for i in l],
+                         [(2, "firkin", "GA")])
+        self.assertEqual(views.parse_item("2 firkins Golden",
+                                          exactmatch=True), [])
+
+    def test_completions_are_ranked(self):
+        def completions(q):
+            return [i.product.code for i in views.parse_item(q, limit=5)]
+        self.assertEqual(completions("1 firkin ga")[0], "GA")
+        self.assertEqual(sorted(completions("1 firkin midnight")),
+                         ["MP", "MS"])
+        # Misspelt
+        self.assertEqual(completions("1 firkin Midnite Stout")[0], "MS")
+        self.assertEqual(completions("1 Goldn Ale"), ["GA"])
+
+    def test_nothing_is_similar_to_nothing(self):
+        for search in (product_index, _product_queries):
+            self.assertEqual(search.similar("", 5), [])
+            self.assertEqual(search.similar(" ", 5), [])
+
+    def test_invoice_details(self):
+        self.client.force_login(self.user)
+        r = self.client.post('/ajax/invoice-details.json', {
+            'q': ["2 firkin Golden Ale", "", "1 firkin Midnight Stout",
+                  "1 firkin Midnight"],
+            'band': self.band.pk, 'contact': 0, 'bill': 'False'}).json()
+        self.assertEqual(r['error'], "")
+        self.assertEqual([(l['total'], l['account'], l['error'])
+                          for l in r['lines']],
+                         [("150.00", "40000", ""), ("", "", ""),
+                          ("75.00", "40000", ""),
+                          ("", "", "Not a valid invoice line")])
+        self.assertEqual(r['total'], "225.00")
+
+    def test_order_lines(self):
+        self.client.force_login(self.user)
+        r = self.client.post('/ajax/order-lines.json', {
+            'text': "2 firkin Golden Ale\n\n1\tfirkin  Midnight\n"
+                    "3 firkin nothing like it",
+            'band': self.band.pk, 'contact': 0, 'bill': 'False'}).json()
+        self.assertEqual([(l['line'], l['item'], l['error'])
+                          for l in r['lines']],
+                         [("2 firkin Golden Ale", "2 firkins Golden Ale", ""),
+                          ("1 firkin Midnight", "",
+                           "Ambiguous invoice line"),
+                          ("3 firkin nothing like it", "",
+                           "Not a valid invoice line")])
+        self.assertEqual(sorted(r['lines'][1]['candidates']),
+                         ["1 firkin Midnight Porter",
+                          "1 firkin Midnight Stout"])
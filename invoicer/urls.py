@@ -8,6 +8,7 @@ urlpatterns = [
     path('invoice/<contactid>/', views.invoice, name="invoice"),
     path('bill/<contactid>/', views.invoice, {'bill': True},
          name="bill"),
+    path('sent/', views.send_jobs, name="send-jobs"),
     path('product/', views.product, name="add-product"),
     path('product/<int:productid>/', views.product, name="edit-product"),
     path('ajax/contact-completions.json', views.contact_completions,
@@ -16,6 +17,11 @@ urlpatterns = [
          name="item-completions"),
     path('ajax/item-details.json', views.item_details,
          name="item-details"),
+    path('ajax/invoice-details.json', views.invoice_details,
+         name="invoice-details"),
+    path('ajax/order-lines.json', views.order_lines,
+         name="order-lines"),
     path('ajax/productcode-check.json', views.productcode_check),
     path('xero/callback/', views.xero_callback),
+    path('xero/quota.json', views.xero_quota, name="xero-quota"),
 ]
@@ -4,13 +4,15 @@ from django.urls import reverse
 from django.db.models import Q
 from django.db import transaction
 from django.utils import timezone
+from django.utils.functional import cached_property
 from django import forms
 from django.conf import settings
 from django.contrib import messages
-from django.template.loader import render_to_string
+from django.template.loader import get_template
 from django.contrib.auth.decorators import login_required
 from invoicer.models import *
-from invoicer import xero
+from invoicer import contacts, sendqueue, xero
+from invoicer.search import product_search
 from decimal import Decimal, ROUND_HALF_UP
 import datetime
 import re
@@ -137,6 +139,7 @@ def startinvoice(request):
             messages.error(request, "Failed to disconnect from Xero")
         return redirect('new-invoice')
 
+    contacts.refresh(request)
     pricebands = PriceBand.objects.all()
     ptypes = ProductType.objects.all()
     if request.method == "POST":
@@ -166,11 +169,12 @@ class ContactOptionsForm(forms.Form):
     priceband = forms.ModelChoiceField(
         queryset=PriceBand.objects,
         label="Price band",
-        widget=forms.Select(attrs={"onChange":'javascript: submit()'}),
     )
     date = forms.DateField(label="Date")
     reference = forms.CharField(label="Reference", max_length=255,
                                 required=False)
+    # Tells sending this draft twice from sending two identical invoices
+    draft = forms.CharField(widget=forms.HiddenInput, required=False)
 
 class _XeroSendFailure(Exception):
     def __init__(self, message):
@@ -207,12 +211,17 @@ def _calc_due(date, days, policy):
     else:
         return None
 
-def _send_to_xero(request, contactid, contact_extra, lines,
-                  bill, date, reference):
+def _prepare_invoice(request, contact_extra, lines, bill, date):
+    """Parse and price invoice lines ready to send to Xero
+
+    Return a list of Xero line items, the products Xero doesn't know
+    about yet, and the due date.
+    """
+    parse = item_parser(request)
     products = set()
     invitems = [] # List of (item, gyle) tuples
     for l in lines:
-        il = parse_item(l['item'], exactmatch=True, contact=contact_extra, isBill=bill)
+        il = parse(l['item'], isBill=bill, contact=contact_extra)
         if len(il) != 1:
             raise _XeroSendFailure(
                 "Ambiguous invoice item '{}'".format(l))
@@ -220,16 +229,21 @@ def _send_to_xero(request, contactid, contact_extra, lines,
         if not item.product.sent:
             products.add(item.product)
         invitems.append((item, l['gyle']))
-
-    if products:
-        problem = xero.update_products(request, products)
-        if problem:
-            raise _XeroSendFailure("Received {} response when sending product "
-                                   "details to Xero.  Products were: {}.".format(
-                                       problem, [p.name for p in products]))
-        for p in products:
-            p.sent = True
-            p.save()
+    priceband = contact_extra.priceband
+    price_items([i for i, gyle in invitems], [priceband])
+
+    xlines = []
+    for i, gyle in invitems:
+        desc = "{} ({}% ABV)".format(i, i.product.abv)
+        if gyle:
+            desc += " (gyle {})".format(gyle)
+        xlines.append({
+            "Description": desc,
+            "ItemCode": i.product.code,
+            "Quantity": str(i.barrels),
+            "AccountCode": i[priceband].account,
+            "UnitAmount": str(i[priceband].priceperbarrel),
+        })
 
     duedate = date + datetime.timedelta(days=31)
     if bill:
@@ -240,27 +254,54 @@ def _send_to_xero(request, contactid, contact_extra, lines,
         if contact_extra.invoice_terms:
             duedate = _calc_due(date, contact_extra.invoice_days,
                                 contact_extra.invoice_terms)
+    return xlines, products, duedate
 
+def _send_to_xero(request, contactid, contact_extra, lines,
+                  bill, date, reference, draft, force=False):
+    xlines, products, duedate = _prepare_invoice(
+        request, contact_extra, lines, bill, date)
     try:
-        invid, warnings = xero.send_invoice(
-            request, contactid, contact_extra.priceband,
-            invitems, bill, date, duedate, reference)
-    except xero.Problem as e:
+        return sendqueue.send(contactid, products, xlines, bill, date,
+                              duedate, reference, draft, force)
+    except xero.ERRORS as e:
         raise _XeroSendFailure("Failed sending to Xero: {}".format(
-            e.message))
-    return invid, warnings
+            xero.message(e)))
+
+def _queue_for_xero(request, contactid, contact_extra, lines,
+                    bill, date, reference, draft):
+    xlines, products, duedate = _prepare_invoice(
+        request, contact_extra, lines, bill, date)
+    return sendqueue.enqueue(request.user, contactid, contact_extra.name,
+                             products, xlines, bill, date, duedate,
+                             reference, draft)
+
+def _discard_draft(session, storename):
+    """Forget an invoice that has been sent or cleared"""
+    del session[storename]
+    session.pop(storename + '-draft', None)
+    session.pop(storename + '-sent', None)
+
+def _invoice_url(invid, bill):
+    return "https://go.xero.com/organisationlogin/default.aspx?shortcode={}&redirecturl=/{}/Edit.aspx?InvoiceID={}".format(
+        settings.XERO_ORGANISATION_SHORTCODE,
+        "AccountsPayable" if bill else "AccountsReceivable",
+        invid)
 
 class InvoiceLineForm(forms.Form):
     def __init__(self, *args, **kwargs):
         super(InvoiceLineForm, self).__init__(*args, **kwargs)
         self.cp = None
+        self.bill = False
+        self.contact = None
+        self.parse = ItemParser()
     item = forms.CharField(max_length=500, required=True)
     gyle = forms.CharField(max_length=10, required=False)
     def clean(self):
         cleaned_data = super(InvoiceLineForm, self).clean()
         if "item" not in cleaned_data:
             return
-        l = parse_item(cleaned_data['item'], exactmatch=True)
+        l = self.parse(cleaned_data['item'], isBill=self.bill,
+                       contact=self.contact)
         if not l:
             raise forms.ValidationError("Not a valid invoice line")
         if len(l) > 1:
@@ -294,10 +335,11 @@ class InvoiceLineForm(forms.Form):
         return ""
 
 class BaseInvoiceLineFormSet(forms.BaseFormSet):
-    def __init__(self, priceband, bill, contact, *args, **kwargs):
+    def __init__(self, priceband, bill, contact, *args, parse=None, **kwargs):
         self.priceband = priceband
         self.bill = bill
         self.contact = contact
+        self.parse = parse or ItemParser()
         super(BaseInvoiceLineFormSet, self).__init__(*args, **kwargs)
     def _construct_form(self, *args, **kwargs):
         # This is very much a hack, because we need to be compatible with
@@ -307,12 +349,19 @@ class BaseInvoiceLineFormSet(forms.BaseFormSet):
         f.priceband = self.priceband
         f.bill = self.bill
         f.contact = self.contact
+        f.parse = self.parse
         if f['item'].value():
-            l = parse_item(f['item'].value(), exactmatch=True,
-                           isBill=self.bill, contact=self.contact)
+            l = self.parse(f['item'].value(), isBill=self.bill,
+                           contact=self.contact)
             if len(l) == 1:
                 f.cp = l[0]
         return f
+    @cached_property
+    def forms(self):
+        forms = super(BaseInvoiceLineFormSet, self).forms
+        if self.priceband:
+            price_items([f.cp for f in forms if f.cp], [self.priceband])
+        return forms
 
 InvoiceLineFormSet = forms.formset_factory(
     InvoiceLineForm, formset=BaseInvoiceLineFormSet, extra=5, can_delete=True)
@@ -327,79 +376,124 @@ def invoice(request, contactid, bill=False):
         contact_extra = None
         rules = []
         contactnumber = 0
-    # Look up the contact in xero if the cached info is out of date or absent
+    # Use the cached info, refreshing it in the background if it's out
+    # of date; only wait for Xero if there's none
     contact = None
-    if not contact_extra or \
-       contact_extra.updated < (timezone.now() - datetime.timedelta(
-           minutes=5)):
-        contact = xero.get_contact(request, contactid)
+    if contact_extra:
+        contacts.refresh_contact(request, contact_extra)
+        contactname = contact_extra.name
+    else:
+        contact = contacts.details(request, contactid)
         if not contact:
             raise Http404
         contactname = contact['Name']
-    else:
-        contactname = contact_extra.name
     if bill:
         storename = contactid + "-bill"
     else:
         storename = contactid
+    already_sent = None
     if request.method == "POST":
         cform = ContactOptionsForm(request.POST)
         priceband = None
         if cform.is_valid():
             priceband = cform.cleaned_data['priceband']
         iform = InvoiceLineFormSet(priceband, bill, contact_extra, request.POST,
-                                   initial=request.session.get(storename))
+                                   initial=request.session.get(storename),
+                                   parse=item_parser(request))
         if cform.is_valid() and iform.is_valid():
-            if not contact_extra:
-                contact_extra = Contact(xero_id=contactid)
-            contact_extra.name = contactname
-            contact_extra.updated = timezone.now()
-            contact_extra.priceband = cform.cleaned_data['priceband']
-            contact_extra.notes = cform.cleaned_data['notes']
-            # We can only update the term fields if we contacted Xero
-            # this request.
             if contact:
+                # We only have details from Xero for contacts we haven't
+                # seen before; those we have are refreshed separately.
+                contact_extra = Contact(xero_id=contactid)
+                contact_extra.name = contactname
+                contact_extra.updated = timezone.now()
                 contact_extra.bill_days = contact.get("BillDay", None)
                 contact_extra.bill_terms = contact.get("BillType", "")
                 contact_extra.invoice_days = contact.get("SaleDay", None)
                 contact_extra.invoice_terms = contact.get("SaleType", "")
-            contact_extra.save()
+            contact_extra.priceband = cform.cleaned_data['priceband']
+            contact_extra.notes = cform.cleaned_data['notes']
+            if contact:
+                contact_extra.save()
+            else:
+                # Not the name and terms, which may be being refreshed in
+                # the background
+                contact_extra.save(update_fields=['priceband', 'notes'])
             request.session[storename] = [
                 i for i in iform.cleaned_data if not i.get('DELETE',True)]
             request.session[storename + '-date'] = cform.cleaned_data['date'].timetuple()
             request.session[storename + '-reference'] = cform.cleaned_data['reference']
-            if "send" in request.POST or "send-background" in request.POST:
+            request.session.pop(storename + '-sent', None)
+            draft = cform.cleaned_data['draft'] or \
+                request.session.get(storename + '-draft', "")
+            if "send" in request.POST or "send-background" in request.POST \
+               or "send-anyway" in request.POST:
                 if not request.session[storename]:
                     messages.warning(request, "There was nothing to send!")
                     return HttpResponseRedirect(request.path)
                 try:
+                    if "send-background" in request.POST:
+                        _queue_for_xero(
+                            request,
+                            contactid, contact_extra, request.session[storename],
+                            bill, cform.cleaned_data['date'], cform.cleaned_data['reference'],
+                            draft)
+                        _discard_draft(request.session, storename)
+                        messages.success(
+                            request, "Invoice for {} queued to send to "
+                            "Xero".format(contactname))
+                        return redirect("new-invoice")
                     invid, warnings = _send_to_xero(
                         request,
                         contactid, contact_extra, request.session[storename],
-                        bill, cform.cleaned_data['date'], cform.cleaned_data['reference'])
-                    del request.session[storename]
-                    iurl = "https://go.xero.com/organisationlogin/default.aspx?shortcode={}&redirecturl=/{}/Edit.aspx?InvoiceID={}".format(
-                        settings.XERO_ORGANISATION_SHORTCODE,
-                        "AccountsPayable" if bill else "AccountsReceivable",
-                        invid)
+                        bill, cform.cleaned_data['date'], cform.cleaned_data['reference'],
+                        draft, force="send-anyway" in request.POST)
+                    if sendqueue.ALREADY_SENT in warnings:
+                        # Most likely the form was submitted twice, but
+                        # keep the draft in case it's wanted again
+                        request.session[storename + '-draft'] = draft
+                        request.session[storename + '-sent'] = invid
+                        return HttpResponseRedirect(request.path)
+                    _discard_draft(request.session, storename)
+                    iurl = _invoice_url(invid, bill)
                     if warnings:
                         return render(request, 'invoicer/invoicewarnings.html',
                                       {"invid": invid,
                                        "iurl": iurl,
                                        "warnings": warnings})
-                    if "send" in request.POST:
-                        return HttpResponseRedirect(iurl)
-                    messages.success(
-                        request,"Invoice for {} sent to Xero".format(contactname))
-                    return redirect("new-invoice")
+                    return HttpResponseRedirect(iurl)
                 except _XeroSendFailure as e:
                     messages.error(request, e.message)
+            elif "paste-lines" in request.POST:
+                added = 0
+                for line, item, candidates in parse_order(
+                        request.POST.get('paste', ''), bill, contact_extra,
+                        item_parser(request)):
+                    if item:
+                        request.session[storename].append(
+                            {'item': str(item), 'gyle': '', 'DELETE': False})
+                        added += 1
+                    elif candidates:
+                        messages.warning(
+                            request, "Not added '{}': did you mean {}?".format(
+                                line, " or ".join(
+                                    "'{}'".format(c) for c in candidates)))
+                    else:
+                        messages.warning(
+                            request, "Not added '{}': not a valid invoice "
+                            "line".format(line))
+                if added:
+                    messages.success(request, "Added {} line{}".format(
+                        added, "s" if added > 1 else ""))
             elif "clear" in request.POST:
-                del request.session[storename]
+                _discard_draft(request.session, storename)
             return HttpResponseRedirect(request.path)
     else:
         iform_initial = request.session.get(storename)
-        initial = {'date': datetime.date.today()}
+        initial = {'date': datetime.date.today(),
+                   'draft': request.session.setdefault(
+                       storename + '-draft', sendqueue.new_draft())}
+        already_sent = request.session.get(storename + '-sent')
         if iform_initial:
             stored_date = request.session.get(storename + "-date")
             if stored_date:
@@ -414,9 +508,11 @@ def invoice(request, contactid, bill=False):
         cform = ContactOptionsForm(initial=initial)
         iform = InvoiceLineFormSet(
             priceband, bill, contact_extra,
-            initial=iform_initial)
+            initial=iform_initial, parse=item_parser(request))
     return render(request, 'invoicer/invoice.html',
                   {"contactname": contactname,
+                   "already_sent": _invoice_url(already_sent, bill)
+                   if already_sent else None,
                    "contactnumber": contactnumber,
                    "rules": rules,
                    "bill": bill,
@@ -428,15 +524,26 @@ def invoice(request, contactid, bill=False):
 @login_required
 def contact_completions(request):
     q = request.GET['q']
-    l = xero.get_contacts(request, q, use_contains=True)
+    l = contacts.search(q)
+    if l is None:
+        # Contacts haven't been copied from Xero yet
+        contacts.refresh(request)
+        try:
+            l = xero.get_contacts(request, q, use_contains=True)
+        except xero.ERRORS:
+            l = []
+        return JsonResponse({
+            'results': [{'id': x["ContactID"], 'text': x["Name"]} for x in l],
+        })
     return JsonResponse({
-        'results': [{'id': x["ContactID"], 'text': x["Name"]} for x in l],
+        'results': [{'id': c.contact_id, 'text': c.name} for c in l],
     })
 
 class InvoiceItemBand:
-    def __init__(self, item, priceband):
-        self.priceperbarrel, self.account, self.reasons \
-            = priceband.apply_rules_for(item)
+    def __init__(self, item, priceband, priced=None):
+        if priced is None:
+            priced = priceband.apply_rules_for(item)
+        self.priceperbarrel, self.account, self.reasons = priced
         self.price = (self.priceperbarrel * item.barrels)\
             .quantize(Decimal("0.01"), rounding=ROUND_HALF_UP)
         self.priceincvat = (self.price * settings.VAT_MULTIPLIER)\
@@ -457,14 +564,36 @@ class InvoiceItem:
             self.product.name)
     def __getitem__(self, key):
         if key not in self._bands:
-            self._bands[key] = InvoiceItemBand(self, key)
+            price_items([self], [key])
         return self._bands[key]
 
+def price_items(items, bands):
+    """Work out the prices of many InvoiceItems in many bands at once
+
+    Prices come from the PriceMatrix where it is enabled, and from the
+    price rules for anything it doesn't cover.
+    """
+    items = [i for i in items if any(b not in i._bands for b in bands)]
+    if items and price_matrix_enabled():
+        for item, row in zip(items, matrix_prices(items, bands)):
+            for band, priced in zip(bands, row):
+                if priced is not None:
+                    item._bands[band] = InvoiceItemBand(item, band, priced)
+        items = [i for i in items if any(b not in i._bands for b in bands)]
+    for item, row in zip(items, price_many(items, bands)):
+        for band, priced in zip(bands, row):
+            if band not in item._bands:
+                item._bands[band] = InvoiceItemBand(item, band, priced)
+
 itemre = re.compile(r'^(?P<qty>\d+)\s*(?P<unit>[\w]+?( keg)?)s?\s+(?P<product>[\w\s&\!\'\/-]+)$')
 shortre = re.compile(r'^(?P<qty>\d+)\s*(?P<product>[\w\s&\!\'\/-]+)$')
 
-def parse_item(description, exactmatch=False, isBill=False, contact=None):
+def parse_item(description, exactmatch=False, isBill=False, contact=None,
+               limit=None):
     """Convert an item description to a list of InvoiceItem objects
+
+    If limit is given, return at most that many, best match first,
+    including products that only match approximately.
     """
     items = 0
     unitname = ""
@@ -481,41 +610,55 @@ def parse_item(description, exactmatch=False, isBill=False, contact=None):
             product = m.group('product')
     if items < 1 or len(product) < 2:
         return []
-    # Find all matching units
-    mu = []
-    units = Unit.objects.all()
-    for k in units:
-        if k.name.startswith(unitname):
-            mu.append(k)
-
-    # For each matching unit, search for matching products.  A product
-    # matches either on the item code or product name if its type also
-    # matches the unit.
-    l = []
-    if exactmatch:
-        productfilter = Q(name=product)
-    else:
-        productfilter = Q(name__icontains=product) | Q(code__icontains=product)
-    for unit in mu:
-        products = Product.objects\
-                          .filter(type=unit.type)\
-                          .filter(productfilter)\
-                          .all()
-        for p in products:
-            l.append(InvoiceItem(items, unit, p, isBill, contact))
+    search = product_search()
+    if limit and not exactmatch:
+        if not search.units(unitname):
+            # "3 dark star" is three of anything called "dark star"
+            m = shortre.match(description)
+            unitname = ""
+            product = m.group('product')
+        return [InvoiceItem(items, unit, p, isBill, contact) for unit, p
+                in search.ranked(unitname, product, limit)]
+    # Find all matching units, and for each of them the matching
+    # products.  A product matches either on the item code or product
+    # name if its type also matches the unit.
+    l = [InvoiceItem(items, unit, p, isBill, contact)
+         for unit, p in search.search(unitname, product, exactmatch)]
     l.sort(key=lambda item:item.product.swap)
     # If the product name entered matches (case-insensitive) the
     # product code, sort this to the top
     l.sort(key=lambda item:item.product.code.lower() != product.lower())
     return l
 
+class ItemParser:
+    """parse_item with exactmatch, remembering the results
+
+    The InvoiceItems are reused for the same description, so each is
+    priced at most once in each band.
+    """
+    def __init__(self):
+        self._items = {}
+
+    def __call__(self, description, isBill=False, contact=None):
+        key = (description, isBill, contact.pk if contact else None)
+        if key not in self._items:
+            self._items[key] = parse_item(description, exactmatch=True,
+                                          isBill=isBill, contact=contact)
+        return self._items[key]
+
+def item_parser(request):
+    """The ItemParser shared by everything handling this request"""
+    if not hasattr(request, '_invoicer_item_parser'):
+        request._invoicer_item_parser = ItemParser()
+    return request._invoicer_item_parser
+
 @login_required
 def item_completions(request):
     try:
         q = request.GET['q']
     except KeyError:
         return JsonResponse(["No q parameter in request"], safe=False)
-    l = parse_item(q)
+    l = parse_item(q, limit=getattr(settings, 'ITEM_COMPLETIONS', 20))
     return JsonResponse([str(i) for i in l], safe=False)
 
 @login_required
@@ -531,43 +674,158 @@ def item_details(request):
         }
     try:
         q = request.GET['q']
-        band = int(request.GET['band'])
-        contact = int(request.GET['contact'])
-        isBill = True if request.GET['bill']=='True' else False
-    except KeyError:
-        d['error'] = "Invalid parameters in request; supply q, band, contact and bill"
+        priceband, contact, isBill = _pricing_params(request.GET)
+    except _BadParameters as e:
+        d['error'] = e.message
+        return JsonResponse(d)
+    l = parse_item(q, exactmatch=True, isBill=isBill, contact=contact)
+    if len(l) != 1:
+        d['error'] = "Ambiguous invoice line"
         return JsonResponse(d)
+    d = _line_details(l[0], priceband)
+    d['error'] = "(Not saved)"
+    return JsonResponse(d)
+
+class _BadParameters(Exception):
+    def __init__(self, message):
+        self.message = message
+
+def _pricing_params(params):
+    """The price band, contact and isBill for an item details request
+    """
+    try:
+        band = int(params['band'])
+        contact = int(params['contact'])
+        isBill = True if params['bill']=='True' else False
+    except (KeyError, ValueError):
+        raise _BadParameters(
+            "Invalid parameters in request; supply band, contact and bill")
     # band will be the pk - integer
     try:
         priceband = PriceBand.objects.get(pk=band)
     except PriceBand.DoesNotExist:
-        d['error'] = "Price band {} does not exist".format(band)
-        return JsonResponse(d)
+        raise _BadParameters("Price band {} does not exist".format(band))
     try:
         contact = Contact.objects.get(pk=contact)
     except Contact.DoesNotExist:
         contact = None
-    l = parse_item(q, exactmatch=True, isBill=isBill, contact=contact)
-    if len(l) != 1:
-        d['error'] = "Ambiguous invoice line"
-        return JsonResponse(d)
-    i = l[0]
-    d = {
-        'abv': "{}%".format(i.product.abv),
-        'barrels': i.barrels,
-        'barrelprice': render_to_string(
-            "invoicer/pricedetail.html",
-            {"price": i[priceband].priceperbarrel,
-             "reasons": i[priceband].reasons,
-             "product": i.product,
+    return priceband, contact, isBill
+
+def _line_details(item, priceband, template=None):
+    """The details of an invoice line shown on the invoice page"""
+    priced = item[priceband]
+    template = template or get_template("invoicer/pricedetail.html")
+    return {
+        'abv': "{}%".format(item.product.abv),
+        'barrels': item.barrels,
+        'barrelprice': template.render(
+            {"price": priced.priceperbarrel,
+             "reasons": priced.reasons,
+             "product": item.product,
             }),
-        'total': i[priceband].price,
-        'incvat': i[priceband].priceincvat,
-        'account': i[priceband].account,
-        'error': "(Not saved)",
+        'total': priced.price,
+        'incvat': priced.priceincvat,
+        'account': priced.account,
+        'error': "",
     }
+
+@login_required
+def invoice_details(request):
+    """Details of every line of an invoice, and its totals
+
+    The lines are given as q, once per line, in order; empty lines
+    have empty details.  With all_bands=True, the details in every
+    price band are also returned, keyed by band.
+    """
+    try:
+        priceband, contact, isBill = _pricing_params(request.POST)
+    except _BadParameters as e:
+        return JsonResponse({'error': e.message})
+    parse = item_parser(request)
+    lines = [parse(q, isBill=isBill, contact=contact) if q.strip() else None
+             for q in request.POST.getlist('q')]
+    bands = [priceband]
+    if request.POST.get('all_bands') == 'True':
+        bands = list(PriceBand.objects.all())
+    price_items([l[0] for l in lines if l and len(l) == 1], bands)
+    template = get_template("invoicer/pricedetail.html")
+    d = _invoice_details(lines, priceband, template)
+    if len(bands) > 1:
+        d['bands'] = {b.pk: _invoice_details(lines, b, template)
+                      for b in bands}
+    d['error'] = ""
     return JsonResponse(d)
 
+def _invoice_details(lines, priceband, template):
+    result = []
+    total = incvat = zero
+    for l in lines:
+        if l and len(l) == 1:
+            d = _line_details(l[0], priceband, template)
+            total += l[0][priceband].price
+            incvat += l[0][priceband].priceincvat
+        else:
+            d = {'abv': '', 'barrels': '', 'barrelprice': '', 'total': '',
+                 'incvat': '', 'account': '', 'error': ''}
+            if l:
+                d['error'] = "Ambiguous invoice line"
+            elif l is not None:
+                d['error'] = "Not a valid invoice line"
+        result.append(d)
+    return {'lines': result, 'total': total, 'incvat': incvat}
+
+def parse_order(text, isBill=False, contact=None, parse=None):
+    """Parse a pasted block of order lines
+
+    Blank lines are skipped.  Return a list of (line, item, candidates)
+    tuples: item is the InvoiceItem for the line, or None if it
+    couldn't be worked out, in which case candidates are the closest
+    matches.  A line with only one candidate is taken to mean that.
+    """
+    parse = parse or ItemParser()
+    result = []
+    for line in text.splitlines():
+        # Tabs and runs of spaces come from spreadsheets
+        line = " ".join(line.split())
+        if not line:
+            continue
+        l = parse(line, isBill=isBill, contact=contact)
+        candidates = []
+        if len(l) != 1:
+            candidates = parse_item(line, isBill=isBill, contact=contact,
+                                    limit=5)
+            l = candidates if len(candidates) == 1 else []
+        result.append((line, l[0] if l else None, candidates))
+    return result
+
+@login_required
+def order_lines(request):
+    """Details of each line of a pasted order, priced together
+    """
+    try:
+        text = request.POST['text']
+        priceband, contact, isBill = _pricing_params(request.POST)
+    except KeyError:
+        return JsonResponse({'error': "Supply text to parse"})
+    except _BadParameters as e:
+        return JsonResponse({'error': e.message})
+    order = parse_order(text, isBill, contact, item_parser(request))
+    price_items([item for line, item, candidates in order if item],
+                [priceband])
+    template = get_template("invoicer/pricedetail.html")
+    lines = []
+    for line, item, candidates in order:
+        if item:
+            d = _line_details(item, priceband, template)
+        else:
+            d = {'error': "Ambiguous invoice line" if candidates
+                 else "Not a valid invoice line"}
+        d['line'] = line
+        d['item'] = str(item) if item else ""
+        d['candidates'] = [str(c) for c in candidates]
+        lines.append(d)
+    return JsonResponse({'lines': lines, 'error': ""})
+
 class ProductForm(forms.ModelForm):
     class Meta:
         model = Product
@@ -583,7 +841,12 @@ class ProductForm(forms.ModelForm):
         # We validate the code if there's no existing product or if
         # the code has changed
         if not (self.instance and code == self.instance.code):
-            xero_match = xero.get_product(self.request, code)
+            try:
+                xero_match = xero.get_product(self.request, code)
+            except xero.ERRORS as e:
+                raise forms.ValidationError(
+                    "Couldn't check code {} with Xero: {}".format(
+                        code, xero.message(e)))
             if xero_match:
                 raise forms.ValidationError(
                     "Code {} already exists in Xero for {}".format(
@@ -615,9 +878,10 @@ def product(request, productid=None):
     # Table has price band across the top, relevant units down the left
     if product:
         rules = Price.objects.filter(product=product).all()
-        bands = PriceBand.objects.all()
+        bands = list(PriceBand.objects.all())
         units = [InvoiceItem(1, x, product, False, None)
                  for x in Unit.objects.filter(type=product.type).all()]
+        price_items(units, bands)
         # XXX this works around the inability of the Django template system
         # to perform dictionary lookups based on variables
         for u in units:
@@ -651,19 +915,30 @@ def productcode_check(request):
         return JsonResponse(
             {'ok': True,
              'error': 'Unchanged'})
+    # Existing products with codes like this one, to catch near-duplicates
+    similar = [{'code': p.code, 'name': p.name}
+               for p in product_search().similar(q, 5) if p != product]
     try:
         np = Product.objects.get(code=q)
         return JsonResponse(
             {'ok': False,
-             'error': 'In use for {}'.format(product.name)})
+             'error': 'In use for {}'.format(np.name),
+             'similar': similar})
     except Product.DoesNotExist:
         pass
-    c = xero.get_product(request, q)
+    try:
+        c = xero.get_product(request, q)
+    except xero.ERRORS as e:
+        return JsonResponse(
+            {'ok': False,
+             'error': "Couldn't check with Xero: {}".format(xero.message(e)),
+             'similar': similar})
     if c:
         return JsonResponse(
             {'ok': False,
-             'error': 'In use on Xero for {}'.format(c)})
-    return JsonResponse({'ok': True, 'error': 'Available'})
+             'error': 'In use on Xero for {}'.format(c),
+             'similar': similar})
+    return JsonResponse({'ok': True, 'error': 'Available', 'similar': similar})
 
 @login_required
 def productname_check(request):
@@ -678,6 +953,17 @@ def productname_check(request):
         pass
     return JsonResponse({'ok': True, 'error': 'Ok'})
 
+@login_required
+def send_jobs(request):
+    jobs = SendJob.objects.select_related('user')[:100]
+    return render(request, 'invoicer/sendjobs.html',
+                  {"jobs": [(j, _invoice_url(j.invoice_id, j.bill)
+                             if j.invoice_id else None) for j in jobs]})
+
+@login_required
+def xero_quota(request):
+    return JsonResponse({'quota': xero.quota()})
+
 @login_required
 def xero_callback(request):
     return xero.connect_callback(request)
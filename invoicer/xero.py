@@ -1,14 +1,36 @@
 from django.shortcuts import render, redirect
+from cryptography.fernet import Fernet, InvalidToken
 import requests
+from requests.adapters import HTTPAdapter
 from requests_oauthlib import OAuth2Session
 from oauthlib.oauth2.rfc6749.errors import OAuth2Error
-from xml.etree.ElementTree import Element, SubElement, tostring, fromstring
+from xml.etree.ElementTree import Element, SubElement, tostring, fromstring, \
+    iterparse, ParseError
 from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
 from django.http import Http404
+from django.utils import timezone
+from django.utils.crypto import salted_hmac
+from invoicer import background
+from invoicer.models import XeroToken
+import base64
 import datetime
+import hashlib
+import json
 import logging
+import random
+import re
+import threading
+import time
 log = logging.getLogger(__name__)
 
+try:
+    import orjson
+    _loads = orjson.loads
+except ImportError:
+    _loads = json.loads
+
 # Zap the very unhelpful behaviour from oauthlib when Xero returns
 # more scopes than requested
 import os
@@ -24,25 +46,69 @@ client_id = settings.XERO_CLIENT_ID
 client_secret = settings.XERO_CLIENT_SECRET
 tenant_id = settings.XERO_ORGANISATION_ID
 
+# Where tokens used to be kept in the session
 token_key = 'xero-token'
 
-def xero_session(request, state=None, omit_tenant=False):
-    kwargs = {}
-    if token_key in request.session:
-        kwargs['token'] = request.session[token_key]
-        def token_updater(token):
-            nonlocal request
-            request.session[token_key] = token
-        kwargs['token_updater'] = token_updater
-        kwargs['auto_refresh_kwargs'] = {
-            'client_id': client_id,
-            'client_secret': client_secret,
-        }
-        kwargs['auto_refresh_url'] = XERO_CONNECT_URL
-    if state:
-        kwargs['state'] = state
-
-    session = OAuth2Session(
+# Shared by every session, so that connections to Xero are kept alive
+# and reused across requests and threads
+_adapter = HTTPAdapter(
+    pool_connections=4,
+    pool_maxsize=getattr(settings, 'XERO_POOL_SIZE', 10))
+
+class _Session(OAuth2Session):
+    """An OAuth2Session using the shared connection pool
+
+    Requests time out after settings.XERO_CONNECT_TIMEOUT and
+    XERO_READ_TIMEOUT seconds unless they say otherwise.
+    """
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.mount("https://", _adapter)
+        self.mount("http://", _adapter)
+
+    def request(self, method, url, *args, **kwargs):
+        kwargs.setdefault('timeout', _timeout())
+        tenant = self.headers.get('xero-tenant-id')
+        if not tenant:
+            # Not a call to the API, so not limited
+            return super().request(method, url, *args, **kwargs)
+        limiter = _limiter(tenant)
+        # Xero recognises a request sent again with the same
+        # Idempotency-Key, and doesn't act on it twice
+        idempotent = method.upper() == "GET" or \
+            'Idempotency-Key' in (kwargs.get('headers') or {})
+        retries = getattr(settings, 'XERO_RETRIES', 3)
+        attempt = 0
+        while True:
+            limiter.acquire()
+            try:
+                r = super().request(method, url, *args, **kwargs)
+            except (requests.ConnectionError, requests.Timeout):
+                if not idempotent or attempt >= retries:
+                    raise
+                r = None
+            finally:
+                limiter.release()
+            if r is not None:
+                limiter.update(r)
+                # Xero doesn't act on requests it refuses with 429, so
+                # they can be sent again whatever they are; the limiter
+                # waits for as long as Xero asked
+                retry = r.status_code == 429 or (
+                    idempotent and r.status_code in (502, 503, 504))
+                if not retry or attempt >= retries:
+                    return r
+                r.close()
+            if r is None or r.status_code != 429:
+                time.sleep(random.uniform(0, min(30, 2 ** attempt)))
+            attempt += 1
+
+def _timeout():
+    return (getattr(settings, 'XERO_CONNECT_TIMEOUT', 5),
+            getattr(settings, 'XERO_READ_TIMEOUT', 60))
+
+def _oauth_session(**kwargs):
+    return _Session(
         client_id,
         redirect_uri="http://localhost:8000/xero/callback/" if settings.DEBUG \
         else "https://milton-invoice.assorted.org.uk/xero/callback/",
@@ -50,17 +116,119 @@ def xero_session(request, state=None, omit_tenant=False):
                "accounting.contacts.read", "accounting.settings"],
         **kwargs)
 
+# The token is shared by everyone using the site, and kept encrypted in
+# XeroToken.  It's refreshed before it expires, by the
+# refreshxerotoken command or in the background when a request notices
+# it's about to, so requests rarely have to wait for a refresh.
+
+def _fernet():
+    return Fernet(base64.urlsafe_b64encode(salted_hmac(
+        "invoicer.xero.token", "fernet", algorithm="sha256").digest()))
+
+def _decrypt(row):
+    """The token in row, or None if it can't be decrypted
+
+    That happens when SECRET_KEY has changed; the row is deleted, so
+    that connecting to Xero again makes a new one.
+    """
+    try:
+        return json.loads(_fernet().decrypt(row.token.encode()))
+    except InvalidToken:
+        log.error("Could not decrypt the stored Xero token; discarding it")
+        row.delete()
+
+def _store(row, token):
+    row.token = _fernet().encrypt(json.dumps(token).encode()).decode()
+    row.expires = datetime.datetime.fromtimestamp(
+        token['expires_at'], tz=datetime.timezone.utc)
+    row.save()
+
+def save_token(token):
+    """Store a new token for our organisation"""
+    row = XeroToken.objects.filter(tenant_id=tenant_id).first() \
+        or XeroToken(tenant_id=tenant_id)
+    _store(row, token)
+
+# Threads in this process wait here rather than on the database
+_refresh_lock = threading.Lock()
+
+def refresh_token(margin=None):
+    """Refresh the stored token if it expires within margin seconds
+
+    The token's row is locked meanwhile, so only one refresh happens at
+    a time; anyone else wanting one waits for it and then finds the
+    token fresh.  Return the token, or None if there isn't one.
+    """
+    if margin is None:
+        margin = getattr(settings, 'XERO_TOKEN_REFRESH_MARGIN', 600)
+    with _refresh_lock, transaction.atomic():
+        row = XeroToken.objects.select_for_update()\
+                               .filter(tenant_id=tenant_id).first()
+        if row is None:
+            return
+        token = _decrypt(row)
+        if token is None or row.expires > timezone.now() + \
+           datetime.timedelta(seconds=margin):
+            return token
+        # oauthlib passes its own timeout, of None, unless given one
+        token = _oauth_session(token=token).refresh_token(
+            XERO_CONNECT_URL, auth=(client_id, client_secret),
+            timeout=_timeout())
+        _store(row, token)
+        log.info("Refreshed Xero token; it expires at %s", row.expires)
+        return token
+
+def current_token():
+    """The stored token, or None if there isn't one
+
+    Only an expired token is refreshed before returning; one that's
+    about to expire is refreshed in the background.
+    """
+    row = XeroToken.objects.filter(tenant_id=tenant_id).first()
+    if row is None:
+        return
+    now = timezone.now()
+    # Leave the token time to be used
+    if row.expires < now + datetime.timedelta(seconds=60):
+        return refresh_token(margin=60)
+    if row.expires < now + datetime.timedelta(seconds=getattr(
+            settings, 'XERO_TOKEN_REFRESH_MARGIN', 600)):
+        background.run_once('refresh-xero-token', refresh_token)
+    return _decrypt(row)
+
+def _json():
+    """Should the API be spoken to in JSON rather than XML?"""
+    return getattr(settings, 'XERO_FORMAT', 'json') == 'json'
+
+def xero_session(request=None, omit_tenant=False):
+    session = _oauth_session(token=current_token())
+
     if not omit_tenant:
-        session.headers = {'xero-tenant-id': tenant_id,
-                           'accept': 'application/xml',
-        }
+        # Keep the default headers, which ask for gzip
+        session.headers.update({'xero-tenant-id': tenant_id,
+                                'accept': 'application/json' if _json()
+                                else 'application/xml',
+        })
+
+    def check_auth(r, *args, **kwargs):
+        # Xero has stopped accepting the token; connection_ok should
+        # check again rather than trust what it found earlier
+        if r.status_code in (401, 403) and session.token:
+            forget_connection(session.token)
+    session.hooks['response'].append(check_auth)
 
     return session
 
-def connection_ok(request):
-    if token_key not in request.session:
-        return False
-    session = xero_session(request, omit_tenant=True)
+def _connection_key(token):
+    return 'invoicer-xero-connection-' + hashlib.sha256(
+        token.get('access_token', '').encode()).hexdigest()
+
+def forget_connection(token):
+    """Make connection_ok check with Xero next time for this token"""
+    cache.delete(_connection_key(token))
+
+def _check_connection():
+    session = xero_session(omit_tenant=True)
     r = session.get(XERO_CONNECTIONS_URL)
     if r.status_code != 200:
         return False
@@ -70,22 +238,54 @@ def connection_ok(request):
             return True
     return False
 
+def connection_ok(request):
+    """Is there a token with access to our organisation?
+
+    Xero is only asked once every settings.XERO_CONNECTION_CHECK_INTERVAL
+    seconds per token, unless it rejects the token meanwhile.
+    """
+    if token_key in request.session:
+        # Tokens used to be kept in each user's session
+        token = request.session.pop(token_key)
+        if not XeroToken.objects.filter(tenant_id=tenant_id).exists():
+            save_token(token)
+    try:
+        token = current_token()
+    except ERRORS as e:
+        log.warning("Could not refresh Xero token: %s", message(e))
+        return False
+    if token is None:
+        return False
+    if cache.get(_connection_key(token)):
+        return True
+    try:
+        ok = _check_connection()
+    except ERRORS + (ValueError,) as e:
+        # Not cached, so that Xero is asked again next time
+        log.warning("Could not check Xero connection: %s", message(e))
+        return False
+    if ok:
+        cache.set(_connection_key(token), True,
+                  getattr(settings, 'XERO_CONNECTION_CHECK_INTERVAL', 3600))
+    return ok
+
 def connect(request):
-    xero = xero_session(request, omit_tenant=True)
+    xero = _oauth_session()
     authorization_url, state = xero.authorization_url(XERO_AUTHORIZE_URL)
     request.session['xero-auth-state'] = state
     return redirect(authorization_url)
 
 def connect_callback(request):
-    xero = xero_session(request, state=request.session['xero-auth-state'],
-                        omit_tenant=True)
+    xero = _oauth_session(state=request.session['xero-auth-state'])
     try:
         token = xero.fetch_token(
             XERO_CONNECT_URL,
             client_id=client_id,
             client_secret=client_secret,
-            authorization_response=request.build_absolute_uri())
-        request.session['xero-token'] = token
+            authorization_response=request.build_absolute_uri(),
+            timeout=_timeout())
+        save_token(token)
+        forget_connection(token)
         return redirect('new-invoice')
     except OAuth2Error as e:
         return render(request, "invoicer/xeroerror.html",
@@ -93,15 +293,136 @@ def connect_callback(request):
     return redirect('/')
 
 def disconnect(request):
-    xero = xero_session(request, omit_tenant=True)
-    r = requests.post(XERO_REVOKE_URL, auth=(client_id, client_secret),
-                      data={'token': xero.token['refresh_token']})
+    token = current_token()
+    if token is None:
+        return False
+    r = _oauth_session().post(
+        XERO_REVOKE_URL, auth=(client_id, client_secret),
+        data={'token': token['refresh_token']})
+    XeroToken.objects.filter(tenant_id=tenant_id).delete()
+    forget_connection(token)
     return r.status_code == 200
 
 class Problem(Exception):
     def __init__(self, message):
         self.message = message
 
+class RateLimited(Problem):
+    pass
+
+class Rejected(Problem):
+    """Xero found something wrong with what was sent; sending it again
+    won't help"""
+    pass
+
+# Everything that can go wrong talking to Xero, short of a bug here
+ERRORS = (Problem, requests.RequestException, OAuth2Error)
+
+def message(e):
+    """A description of one of ERRORS"""
+    return getattr(e, 'message', None) or str(e)
+
+class _Limiter:
+    """Xero's limits on API calls for one tenant
+
+    A token bucket lets through settings.XERO_CALLS_PER_MINUTE calls a
+    minute, at most XERO_CONCURRENT_CALLS at once; further calls wait
+    their turn, for up to XERO_QUEUE_TIMEOUT seconds.  What Xero says
+    is left of its quotas, and how long it says to wait after refusing
+    a call, take precedence.
+    """
+    def __init__(self, tenant):
+        self.tenant = tenant
+        self.rate = getattr(settings, 'XERO_CALLS_PER_MINUTE', 60)
+        self.tokens = self.rate
+        self.stamp = time.monotonic()
+        self.not_before = self.stamp
+        self.lock = threading.Lock()
+        self.calls = threading.BoundedSemaphore(
+            getattr(settings, 'XERO_CONCURRENT_CALLS', 5))
+
+    def _wait(self):
+        """Seconds before the next call, taking a token if it can go now"""
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.rate, self.tokens + (
+                now - self.stamp) * self.rate / 60)
+            self.stamp = now
+            if now < self.not_before:
+                return self.not_before - now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return 0
+            return (1 - self.tokens) * 60 / self.rate
+
+    def acquire(self):
+        deadline = time.monotonic() + getattr(
+            settings, 'XERO_QUEUE_TIMEOUT', 60)
+        while True:
+            wait = self._wait()
+            if not wait:
+                break
+            if time.monotonic() + wait > deadline:
+                raise RateLimited("Xero's limit on calls has been reached; "
+                                  "try again in {:.0f} seconds".format(wait))
+            time.sleep(wait)
+        if not self.calls.acquire(
+                timeout=max(0, deadline - time.monotonic())):
+            raise RateLimited("Too many calls to Xero at once")
+
+    def release(self):
+        self.calls.release()
+
+    def update(self, r):
+        """Take note of what response r says about the limits"""
+        minute = r.headers.get('X-MinLimit-Remaining')
+        day = r.headers.get('X-DayLimit-Remaining')
+        with self.lock:
+            if minute is not None:
+                # Other processes may have been using the quota too
+                self.tokens = min(self.tokens, int(minute))
+            if r.status_code == 429:
+                try:
+                    retry_after = int(r.headers.get('Retry-After', 60))
+                except ValueError:
+                    retry_after = 60
+                log.warning("Xero refused a call (%s limit); retrying "
+                            "after %d seconds",
+                            r.headers.get('X-Rate-Limit-Problem', "unknown"),
+                            retry_after)
+                self.tokens = 0
+                self.not_before = max(self.not_before,
+                                      time.monotonic() + retry_after)
+        if minute is not None or day is not None:
+            q = quota(self.tenant) or {}
+            if minute is not None:
+                q['minute_remaining'] = int(minute)
+            if day is not None:
+                q['day_remaining'] = int(day)
+            q['updated'] = time.time()
+            cache.set(_quota_key(self.tenant), q, 86400)
+
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+def _limiter(tenant):
+    with _limiters_lock:
+        limiter = _limiters.get(tenant)
+        if limiter is None:
+            limiter = _limiters[tenant] = _Limiter(tenant)
+        return limiter
+
+def _quota_key(tenant):
+    return 'invoicer-xero-quota-' + tenant
+
+def quota(tenant=tenant_id):
+    """What Xero last said was left of its quotas for tenant
+
+    A dict with minute_remaining, day_remaining and updated (a
+    timestamp), or None if there hasn't been a call recently.
+    """
+    return cache.get(_quota_key(tenant))
+
 def _textelem(name, text):
     e = Element(name)
     e.text = text
@@ -121,6 +442,25 @@ def _contact_to_dict(c):
                               _fieldtext(c, "LastName") or ""]),
     }
 
+def _contact_from_json(c):
+    """A dict as from _contact_to_dict and _payment_terms, from JSON"""
+    d = {
+        "ContactID": c["ContactID"],
+        "Name": c.get("Name"),
+        "FullName": " ".join([c.get("FirstName") or "",
+                              c.get("LastName") or ""]),
+    }
+    terms = c.get("PaymentTerms") or {}
+    bills = terms.get("Bills")
+    if bills:
+        d["BillDay"] = int(bills["Day"])
+        d["BillType"] = bills["Type"]
+    sales = terms.get("Sales")
+    if sales:
+        d["SaleDay"] = int(sales["Day"])
+        d["SaleType"] = sales["Type"]
+    return d
+
 def get_contacts(request, q, use_contains=False):
     session = xero_session(request)
     if use_contains:
@@ -133,7 +473,10 @@ def get_contacts(request, q, use_contains=False):
     if r.status_code != 200:
         log.error("Xero API returned status code %d during get_contacts; text was %s", r.status_code, r.text)
         return []
-    root = fromstring(r.text)
+    if _json():
+        return [_contact_from_json(c)
+                for c in _parse(r).get("Contacts") or []]
+    root = _parse(r)
     if root.tag != "Response":
         return []
     contacts = root.find("Contacts")
@@ -141,26 +484,138 @@ def get_contacts(request, q, use_contains=False):
         return []
     return [_contact_to_dict(c) for c in contacts.findall("Contact")]
 
+def _parse(r):
+    """The body of response r, as a dict or an XML root element
+
+    Raises Problem for a body that didn't come from the API, such as a
+    proxy's error page.
+    """
+    try:
+        body = _loads(r.content) if _json() else fromstring(r.text)
+    except (ValueError, ParseError):
+        raise Problem("Received an unreadable response: {}".format(
+            r.text[:200]))
+    if _json() and not isinstance(body, dict):
+        raise Problem("Received an unexpected response: {}".format(
+            r.text[:200]))
+    return body
+
+def _parse_datetime(text):
+    """A Xero UTC timestamp, eg. 2016-03-22T09:48:07.763"""
+    if not text:
+        return
+    if "." in text:
+        # Python only parses up to six digits of fractions of a second
+        whole, fraction = text.split(".", 1)
+        text = "{}.{:0<6.6}".format(whole, fraction)
+    return datetime.datetime.fromisoformat(text).replace(
+        tzinfo=datetime.timezone.utc)
+
+_json_date = re.compile(r"/Date\((-?\d+)([+-]\d{4})?\)/")
+
+def _parse_json_date(text):
+    """A Xero UTC timestamp in JSON, eg. /Date(1439434356790+0000)/"""
+    m = _json_date.match(text or "")
+    if not m:
+        return _parse_datetime(text)
+    return datetime.datetime.fromtimestamp(
+        int(m.group(1)) / 1000, tz=datetime.timezone.utc)
+
+def _payment_terms(c, d):
+    """Add the payment terms of contact element c to dict d"""
+    bills = c.find("PaymentTerms/Bills")
+    if bills:
+        d["BillDay"] = int(_fieldtext(bills, "Day"))
+        d["BillType"] = _fieldtext(bills, "Type")
+    sales = c.find("PaymentTerms/Sales")
+    if sales:
+        d["SaleDay"] = int(_fieldtext(sales, "Day"))
+        d["SaleType"] = _fieldtext(sales, "Type")
+
+def _page_of_contacts_xml(r):
+    r.raw.decode_content = True
+    path = []
+    try:
+        for event, e in iterparse(r.raw, events=("start", "end")):
+            if event == "start":
+                if not path and e.tag != "Response":
+                    raise Problem("Response root tag '{}' was not "
+                                  "'Response'".format(e.tag))
+                path.append(e.tag)
+                continue
+            if path == ["Response", "Contacts", "Contact"]:
+                d = _contact_to_dict(e)
+                d["ContactStatus"] = _fieldtext(e, "ContactStatus") or ""
+                d["UpdatedDateUTC"] = _parse_datetime(
+                    _fieldtext(e, "UpdatedDateUTC"))
+                _payment_terms(e, d)
+                yield d
+                e.clear()
+            path.pop()
+    except ParseError as e:
+        raise Problem("Received an unreadable response: {}".format(e))
+
+def _page_of_contacts_json(r):
+    for c in _parse(r).get("Contacts") or []:
+        d = _contact_from_json(c)
+        d["ContactStatus"] = c.get("ContactStatus") or ""
+        d["UpdatedDateUTC"] = _parse_json_date(c.get("UpdatedDateUTC"))
+        yield d
+
+def iter_contacts(request, modified_since=None):
+    """Contacts on Xero changed since modified_since (a datetime), or all
+
+    Yields dicts as from get_contact, with ContactStatus and
+    UpdatedDateUTC as well, in order of UpdatedDateUTC.  Archived
+    contacts are included, so that a copy can see them being archived.
+    Each page of an XML response is parsed as it arrives.
+    """
+    session = xero_session(request)
+    headers = {}
+    if modified_since:
+        headers["If-Modified-Since"] = modified_since.astimezone(
+            datetime.timezone.utc).strftime("%Y-%m-%dT%H:%M:%S")
+    page_of_contacts = _page_of_contacts_json if _json() \
+        else _page_of_contacts_xml
+    page = 1
+    while True:
+        with session.get(XERO_ENDPOINT_URL + "Contacts/", params={
+                "page": page, "order": "UpdatedDateUTC",
+                "includeArchived": "true"}, headers=headers,
+                         stream=True) as r:
+            if r.status_code == 304:
+                return
+            if r.status_code != 200:
+                raise Problem(
+                    "Received {} response fetching contacts".format(
+                        r.status_code))
+            count = 0
+            for d in page_of_contacts(r):
+                count += 1
+                yield d
+        # Xero returns up to 100 contacts per page
+        if count < 100:
+            return
+        page += 1
+
 def get_contact(request, contactid):
     session = xero_session(request)
     r = session.get(XERO_ENDPOINT_URL + "Contacts/" + contactid)
     if r.status_code != 200:
         raise Http404
-    root = fromstring(r.text)
+    if _json():
+        contacts = _parse(r).get("Contacts")
+        if not contacts:
+            return
+        return _contact_from_json(contacts[0])
+    root = _parse(r)
     if root.tag != "Response":
         return
     c = root.find("./Contacts/Contact")
     if not c:
         return
     d = _contact_to_dict(c)
-    bills = c.find("PaymentTerms/Bills")
-    if bills:
-        d["BillDay"] = int(_fieldtext(bills, "Day"))
-        d["BillType"] = _fieldtext(bills, "Type")
-    sales = c.find("PaymentTerms/Sales")
-    if sales:
-        d["SaleDay"] = int(_fieldtext(sales, "Day"))
-        d["SaleType"] = _fieldtext(sales, "Type")
+    _payment_terms(c, d)
     return d
 
 def get_product(request, code):
@@ -168,7 +623,12 @@ def get_product(request, code):
     r = session.get(XERO_ENDPOINT_URL + "Items/" + code)
     if r.status_code != 200:
         return
-    root = fromstring(r.text)
+    if _json():
+        items = _parse(r).get("Items")
+        if not items:
+            raise Problem("Response did not contain item details")
+        return items[0].get("Description")
+    root = _parse(r)
     if root.tag != "Response":
         return
     i = root.find("./Items/Item")
@@ -179,6 +639,18 @@ def get_product(request, code):
 
 def update_products(request, products):
     session = xero_session(request)
+    if _json():
+        body = json.dumps({"Items": [
+            {"Code": p.code, "Name": str(p), "Description": str(p)}
+            for p in products]})
+        r = session.post(XERO_ENDPOINT_URL + "Items/",
+                         headers={'Idempotency-Key': _key(body),
+                                  'Content-Type': 'application/json'},
+                         data=body.encode())
+        if r.status_code != 200:
+            log.error("%s", r.text)
+            return r.status_code
+        return
     items = Element("Items")
     for p in products:
         item = Element("Item")
@@ -189,17 +661,15 @@ def update_products(request, products):
 
     xml = tostring(items)
     r = session.post(XERO_ENDPOINT_URL + "Items/",
-                      data={'xml': xml})
+                     headers={'Idempotency-Key': _key(xml.decode())},
+                     data={'xml': xml})
     if r.status_code != 200:
         log.error("%s", r.text)
         return r.status_code
 
-def send_invoice(request, contactid, priceband, items,
-                 bill, date, duedate, reference):
-    session = xero_session(request)
-    # items is a list of (item, gyle) tuples
-    invoices = Element("Invoices")
-    inv = SubElement(invoices, "Invoice")
+def _invoice_element(contactid, lines, bill, date, duedate, reference):
+    # lines is a list of dicts of LineItem fields
+    inv = Element("Invoice")
     inv.append(_textelem("Type", "ACCPAY" if bill else "ACCREC"))
     c = SubElement(inv, "Contact")
     c.append(_textelem("ContactID", contactid))
@@ -216,45 +686,155 @@ def send_invoice(request, contactid, priceband, items,
         else:
             inv.append(_textelem("Reference", reference))
     litems = SubElement(inv, "LineItems")
-    for i, gyle in items:
+    for l in lines:
         li = SubElement(litems, "LineItem")
-        desc = "{} ({}% ABV)".format(i, i.product.abv)
-        if gyle:
-            desc += " (gyle {})".format(gyle)
-        li.append(_textelem("Description", desc))
-        li.append(_textelem("ItemCode", i.product.code))
-        li.append(_textelem("Quantity", str(i.barrels)))
-        li.append(_textelem("AccountCode", i[priceband].account))
-        li.append(_textelem("UnitAmount", str(i[priceband].priceperbarrel)))
-    xml = tostring(invoices)
-    r = session.put(XERO_ENDPOINT_URL + "Invoices/",
-                     data={'xml': xml})
+        for field in ("Description", "ItemCode", "Quantity", "AccountCode",
+                      "UnitAmount"):
+            li.append(_textelem(field, l[field]))
+    return inv
+
+def _invoice_json(contactid, lines, bill, date, duedate, reference):
+    inv = {
+        "Type": "ACCPAY" if bill else "ACCREC",
+        "Contact": {"ContactID": contactid},
+        "LineAmountTypes": "Exclusive",
+        "Date": date.isoformat(),
+        # Quantities and amounts stay exact decimal strings, as in XML;
+        # Xero reads them as numbers
+        "LineItems": [{field: l[field] for field in (
+            "Description", "ItemCode", "Quantity", "AccountCode",
+            "UnitAmount")} for l in lines],
+    }
+    if duedate:
+        inv["DueDate"] = duedate.isoformat()
+    if reference:
+        inv["InvoiceNumber" if bill else "Reference"] = reference
+    return inv
+
+def _json_messages(d):
+    """Messages from a JSON error response, as .//Message in XML"""
+    messages = [d["Message"]] if d.get("Message") else []
+    for e in d.get("Elements") or []:
+        messages += [v["Message"] for v in e.get("ValidationErrors") or []]
+    return messages
+
+def _key(*parts):
+    return hashlib.sha256(json.dumps(parts, sort_keys=True).encode())\
+                  .hexdigest()
+
+def invoice_key(contactid, lines, bill, date, duedate, reference,
+                draft=None):
+    """A key that's the same for the same draft of an invoice
+
+    Without a draft, it's the same for invoices with the same contents.
+    """
+    parts = [contactid, lines, bill, date.isoformat(),
+             duedate.isoformat() if duedate else None, reference]
+    if draft:
+        parts.append(draft)
+    return _key(*parts)
+
+def batch_key(keys):
+    """The idempotency key for sending invoices with keys together"""
+    return keys[0] if len(keys) == 1 else _key(*keys)
+
+def send_invoices(request, invoices, keys=None):
+    """Send several invoices and bills to Xero in one request
+
+    invoices is a list of dicts of send_invoice's arguments, and keys
+    their invoice_keys if they aren't worked out from that.  Return a
+    list of (invoice ID, warnings, error) in the same order; error is
+    None unless Xero rejected that invoice, and then there's no ID.
+
+    Sending the same invoices again is safe for a while: Xero returns
+    the same response rather than creating them twice.
+    """
+    session = xero_session(request)
+    if keys is None:
+        keys = [invoice_key(**i) for i in invoices]
+    # Without SummarizeErrors=false one bad invoice fails the lot
+    params = {"SummarizeErrors": "false"}
+    headers = {'Idempotency-Key': batch_key(keys)}
+    if _json():
+        headers['Content-Type'] = 'application/json'
+        r = session.put(XERO_ENDPOINT_URL + "Invoices/", params=params,
+                        headers=headers, data=json.dumps({"Invoices": [
+                            _invoice_json(**i) for i in invoices]}).encode())
+    else:
+        root = Element("Invoices")
+        for i in invoices:
+            root.append(_invoice_element(**i))
+        r = session.put(XERO_ENDPOINT_URL + "Invoices/", params=params,
+                        headers=headers, data={'xml': tostring(root)})
     if r.status_code == 400:
-        root = fromstring(r.text)
-        messages = [e.text for e in root.findall(".//Message")]
-        raise Problem("Xero rejected invoice: {}".format(", ".join(messages)))
+        try:
+            if _json():
+                messages = _json_messages(_loads(r.content))
+            else:
+                messages = [e.text for e in fromstring(r.text).findall(
+                    ".//Message")]
+        except (ValueError, AttributeError, ParseError):
+            # Not from the API itself, so perhaps worth trying again
+            raise Problem("Received 400 response: {}".format(r.text))
+        raise Rejected("Xero rejected invoice: {}".format(", ".join(messages)))
     if r.status_code != 200:
         raise Problem("Received {} response".format(r.status_code))
-    root = fromstring(r.text)
-    if root.tag != "Response":
-        raise Problem("Response root tag '{}' was not 'Response'".format(
-            root.tag))
-    i = root.find("./Invoices/Invoice")
-    if not i:
-        raise Problem("Response did not contain invoice details")
-    invid = _fieldtext(i, "InvoiceID")
-    if not invid:
-        raise Problem("No invoice ID was returned")
-    warnings = [w.text for w in i.findall("./Warnings/Warning/Message")]
+
+    # (InvoiceID, status, warnings, errors) for each invoice
+    # Sending again with the same idempotency key is safe
+    body = _parse(r)
+    if _json():
+        returned = [(i.get("InvoiceID"), i.get("StatusAttributeString"),
+                     [w["Message"] for w in i.get("Warnings") or []],
+                     [e["Message"] for e in i.get("ValidationErrors") or []])
+                    for i in body.get("Invoices") or []]
+    else:
+        root = body
+        if root.tag != "Response":
+            raise Problem("Response root tag '{}' was not 'Response'".format(
+                root.tag))
+        returned = [(_fieldtext(i, "InvoiceID"),
+                     _fieldtext(i, "StatusAttributeString"),
+                     [w.text for w in i.findall("./Warnings/Warning/Message")],
+                     [e.text for e in i.findall(
+                         "./ValidationErrors/ValidationError/Message")])
+                    for i in root.findall("./Invoices/Invoice")]
+    if len(returned) != len(invoices):
+        raise Problem("Sent {} invoices but Xero returned details of "
+                      "{}".format(len(invoices), len(returned)))
+    results = []
+    for invid, status, warnings, errors in returned:
+        if errors or status == "ERROR":
+            results.append((None, warnings, "Xero rejected invoice: {}".format(
+                ", ".join(errors))))
+            continue
+        if not invid:
+            raise Problem("No invoice ID was returned")
+        results.append((invid, warnings, None))
+    return results
+
+def send_invoice(request, contactid, lines,
+                 bill, date, duedate, reference, draft=None):
+    invoice = {'contactid': contactid, 'lines': lines, 'bill': bill,
+               'date': date, 'duedate': duedate, 'reference': reference}
+    (invid, warnings, error), = send_invoices(
+        request, [invoice], [invoice_key(draft=draft, **invoice)])
+    if error:
+        raise Rejected(error)
     return invid, warnings
 
-def test_connection(request):
+def test_connection(request=None):
     """Test the connection to Xero by retrieving organisation name"""
     session = xero_session(request)
     r = session.get(XERO_ENDPOINT_URL + "Organisation/")
     if r.status_code != 200:
         return "Connection failed: status code {}".format(r.status_code)
-    root = fromstring(r.text)
+    if _json():
+        orgs = _parse(r).get("Organisations")
+        if not orgs:
+            return "Connection failed: no organisation details in response"
+        return orgs[0].get("Name")
+    root = _parse(r)
     if root.tag != "Response":
         return "Connection failed: root of response was not 'Response'."
     org = None
@@ -36,6 +36,7 @@ INSTALLED_APPS = (
     'django.contrib.sessions',
     'django.contrib.messages',
     'django.contrib.staticfiles',
+    'django.contrib.postgres',
     'invoicer',
 )
 
@@ -129,3 +130,19 @@ XERO_ORGANISATION_SHORTCODE = read("xero-shortcode")
 # Current VAT multiplier
 from decimal import Decimal
 VAT_MULTIPLIER = Decimal("1.20")
+
+# Keep the materialized PriceMatrix table up to date and use it for
+# pricing.  After turning this on, run "./manage.py pricematrix --rebuild".
+PRICE_MATRIX = False
+
+# Work out prices in integer pence where the rules allow it.  Check
+# with "./manage.py checkpricing" before turning this on.
+INTEGER_PRICING = False
+
+# Where parse_item looks up products: "memory" keeps an index of every
+# product in each process; "database" queries the trigram indexes.
+PRODUCT_SEARCH = "memory"
+
+# How to talk to the Xero API: "json" (decoded with orjson if it's
+# installed) or "xml".
+XERO_FORMAT = "json"